@@ -1,19 +1,12 @@
-import contextlib
+import collections
 import os
-from pathlib import Path
 from PyQt5.QtWidgets import (QApplication, QFileDialog, QLabel, QMessageBox, QProgressBar, QPushButton,
                              QVBoxLayout, QWidget, QCheckBox, QHBoxLayout, QLineEdit, QDialog, QDialogButtonBox, QGroupBox)
-from PyQt5.QtCore import Qt
-import re
-import shutil
-import zipfile
-import rarfile
-from pyunpack import Archive
+from PyQt5.QtCore import QObject, Qt, QThread, QTimer, pyqtSignal
 from datetime import datetime
-import fnmatch
-import json
 from PyQt5.QtGui import QFont, QIcon, QColor, QPalette, QStandardItemModel, QStandardItem
 from PyQt5.QtWidgets import QTreeView, QTreeWidgetItem
+from archistack_core import ExtractorCore, FolderWatcher, Progress
 
 # Add a class for handling custom criteria
 
@@ -60,12 +53,43 @@ class CustomCriteriaDialog(QDialog):
         return self.name_input.text(), [ext.strip() for ext in self.extensions_input.text().split(',')], self.pattern_input.text()
 
 
-class Extractor(QWidget):
-    def __init__(self):
+class TaskWorker(QObject):
+    """Runs one long task on a QThread and reports back through signals"""
+
+    # files, total files (-1 if unknown), files/s, bytes/s, ETA in s (-1 if unknown)
+    progress = pyqtSignal(int, int, float, float, float)
+    finished = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, task, *args):
         super().__init__()
-        # Define the criteria attribute
-        self.criteria = {}
+        self.task = task
+        self.args = args
+        self.tracker = Progress(self._emit_progress)
+
+    def _emit_progress(self, files, total_files, files_per_second, bytes_per_second, eta):
+        self.progress.emit(files, -1 if total_files is None else total_files,
+                           files_per_second, bytes_per_second, -1 if eta is None else eta)
+
+    def run(self):
+        try:
+            result = self.task(*self.args, progress=self.tracker)
+        except Exception as e:
+            self.failed.emit(str(e))
+            return
+        self.tracker.report()
+        self.finished.emit(result)
 
+
+class Extractor(ExtractorCore, QWidget):
+    # New files found by the folder watcher, delivered on the GUI thread
+    files_arrived = pyqtSignal(list)
+
+    def __init__(self):
+        super().__init__()
+        # Sort by the built-in categories, as the command line does
+        self.criteria = dict(self.categories)
+        self.criteria_checkboxes = []
         self.setWindowTitle("ArchiStack")
         self.setFixedSize(500, 300)
 
@@ -96,52 +120,14 @@ class Extractor(QWidget):
         self.criteria_description_label = QLabel()
         layout.addWidget(self.criteria_description_label)
 
-        # Initialize custom criteria
-        self.custom_criteria = {}  # Add this line
-        self.load_custom_criteria()
+        self.worker_thread = None
+        self.worker = None
+        self.busy = False
+        self.folder_watcher = None
+        # New files waiting for the current background task to finish
+        self.watch_pending = {}
+        self.files_arrived.connect(self._queue_new_files)
 
-        self.destination_folders = []
-        self.categories = {'Audio': {
-            'extensions': ['*.mp3', '*.wav', '*.ogg', '*.flac', '*.m4a', '*.aac', '*.wma'],
-            'pattern': 'audio*'
-        },
-            'Images': {
-            'extensions': ['*.jpg', '*.jpeg', '*.png', '*.bmp', '*.tiff', '*.gif', '*.webp', '*.ico'],
-            'pattern': 'image*'
-        },
-            'Documents': {
-            'extensions': ['*.pdf', '*.txt', '*.doc', '*.docx', '*.xls', '*.xlsx', '*.ppt', '*.pptx', '*.odt', '*.ods', '*.odp', '*.rtf', '*.csv'],
-            'pattern': 'doc*'
-        },
-            'Videos': {
-            'extensions': ['*.mp4', '*.avi', '*.mkv', '*.mov', '*.wmv', '*.flv', '*.m4v', '*.h264'],
-            'pattern': 'video*'
-        },
-            'Compressed': {
-            'extensions': ['*.zip', '*.rar', '*.7z', '*.tar', '*.gz', '*.bz2', '*.xz', '*.iso'],
-            'pattern': 'compressed*'
-        },
-            'Code': {
-            'extensions': ['*.py', '*.js', '*.html', '*.css', '*.php', '*.java', '*.cpp', '*.c', '*.cs', '*.sh', '*.bat', '*.swift', '*.go', '*.rb'],
-            'pattern': 'code*'
-        },
-            'Database': {
-            'extensions': ['*.db', '*.sql', '*.sqlite', '*.sqlite3', '*.mdb', '*.accdb'],
-            'pattern': 'database*'
-        },
-            'Fonts': {
-            'extensions': ['*.ttf', '*.otf', '*.woff', '*.woff2', '*.eot', '*.fon'],
-            'pattern': 'font*'
-        },
-            'Executable': {
-            'extensions': ['*.exe', '*.app', '*.bin', '*.msi', '*.dmg', '*.apk', '*.ipa'],
-            'pattern': 'executable*'
-        },
-            'Sims 4 Mods': {
-            'extensions': ['*.ts4script', '*.package', '*.trayitem', '*.blueprint', '*.room', '*.householdbinary', '*.bpi'],
-            'pattern': 'sims4mod*'
-        }
-        }
         main_layout = QVBoxLayout()
 
         # Initialize treeview
@@ -156,8 +142,14 @@ class Extractor(QWidget):
         sort_group_layout.setSpacing(5)
 
         # Add checkboxes for sorting criteria
-        checkboxes_layout = self.init_checkboxes()
-        sort_group_layout.addLayout(checkboxes_layout)
+        self.checkboxes_layout = QVBoxLayout()
+        self.init_checkboxes()
+        sort_group_layout.addLayout(self.checkboxes_layout)
+
+        self.recursive_checkbox = QCheckBox("Include subfolders")
+        self.recursive_checkbox.setToolTip(
+            "Also sort files in nested folders, streaming through the whole tree")
+        sort_group_layout.addWidget(self.recursive_checkbox)
 
         self.sort_button = QPushButton("Sort Files")
         self.sort_button.setToolTip(
@@ -165,6 +157,18 @@ class Extractor(QWidget):
         self.sort_button.clicked.connect(self.sort_files)
         sort_group_layout.addWidget(self.sort_button)
 
+        self.watch_button = QPushButton("Watch Folder")
+        self.watch_button.setCheckable(True)
+        self.watch_button.setToolTip(
+            "Extract and sort new files as they arrive in a folder")
+        self.watch_button.toggled.connect(self.toggle_watch)
+        sort_group_layout.addWidget(self.watch_button)
+
+        self.dedupe_checkbox = QCheckBox("Set duplicates aside")
+        self.dedupe_checkbox.setToolTip(
+            "Move watched files that are already in their category folder to a duplicates folder")
+        sort_group_layout.addWidget(self.dedupe_checkbox)
+
         sort_group.setLayout(sort_group_layout)
         main_layout.addWidget(sort_group)
 
@@ -194,9 +198,14 @@ class Extractor(QWidget):
         self.extract_button.clicked.connect(self.extract_files)
         action_buttons_layout.addWidget(self.extract_button)
 
+        self.sort_on_extract_checkbox = QCheckBox("Sort while extracting")
+        self.sort_on_extract_checkbox.setToolTip(
+            "Write each archive member straight into its category folder")
+        action_buttons_layout.addWidget(self.sort_on_extract_checkbox)
+
         self.undo_button = QPushButton("Undo Last Action")
         self.undo_button.setEnabled(False)
-        self.undo_button.clicked.connect(self.undo_process)
+        self.undo_button.clicked.connect(self.undo_last)
         action_buttons_layout.addWidget(self.undo_button)
 
         self.undo_specific_button = QPushButton("Undo Specific Folder")
@@ -211,181 +220,40 @@ class Extractor(QWidget):
 
         main_layout.addLayout(action_buttons_layout)
 
-        self.checkboxes_layout = QVBoxLayout()
-        self.init_checkboxes()
-
         # Initialize status label
         self.status_label = QLabel()
         main_layout.addWidget(self.status_label)
 
-        self.setLayout(main_layout)
-        self.extracted_files = []
-        self.show()
+        # Progress of the sort, extract or undo running in the background
+        progress_layout = QHBoxLayout()
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setVisible(False)
+        progress_layout.addWidget(self.progress_bar)
 
-    def init_checkboxes(self):
-        """Initialize checkboxes for criteria"""
-        for i in reversed(range(self.checkboxes_layout.count())):
-            widget = self.checkboxes_layout.takeAt(i).widget()
-            if widget:
-                widget.setParent(None)
-
-        self.criteria = {
-            'Audio': {
-                'extensions': ['*.mp3', '*.wav', '*.ogg', '*.flac', '*.m4a', '*.aac', '*.wma'],
-                'pattern': 'audio*'
-            },
-            'Images': {
-                'extensions': ['*.jpg', '*.jpeg', '*.png', '*.bmp', '*.tiff', '*.gif', '*.webp', '*.ico'],
-                'pattern': 'image*'
-            },
-            'Documents': {
-                'extensions': ['*.pdf', '*.txt', '*.doc', '*.docx', '*.xls', '*.xlsx', '*.ppt', '*.pptx', '*.odt', '*.ods', '*.odp', '*.rtf', '*.csv'],
-                'pattern': 'doc*'
-            },
-            'Videos': {
-                'extensions': ['*.mp4', '*.avi', '*.mkv', '*.mov', '*.wmv', '*.flv', '*.m4v', '*.h264'],
-                'pattern': 'video*'
-            },
-            'Compressed': {
-                'extensions': ['*.zip', '*.rar', '*.7z', '*.tar', '*.gz', '*.bz2', '*.xz', '*.iso'],
-                'pattern': 'compressed*'
-            },
-            'Code': {
-                'extensions': ['*.py', '*.js', '*.html', '*.css', '*.php', '*.java', '*.cpp', '*.c', '*.cs', '*.sh', '*.bat', '*.swift', '*.go', '*.rb'],
-                'pattern': 'code*'
-            },
-            'Database': {
-                'extensions': ['*.db', '*.sql', '*.sqlite', '*.sqlite3', '*.mdb', '*.accdb'],
-                'pattern': 'database*'
-            },
-            'Fonts': {
-                'extensions': ['*.ttf', '*.otf', '*.woff', '*.woff2', '*.eot', '*.fon'],
-                'pattern': 'font*'
-            },
-            'Executable': {
-                'extensions': ['*.exe', '*.app', '*.bin', '*.msi', '*.dmg', '*.apk', '*.ipa'],
-                'pattern': 'executable*'
-            },
-            'Sims 4 Mods': {
-                'extensions': ['*.ts4script', '*.package', '*.trayitem', '*.blueprint', '*.room', '*.householdbinary', '*.bpi'],
-                'pattern': 'sims4mod*'
-            },
-            'Custom Content': {
-                'extensions': ['*.package'],
-                'pattern': 'cc_*'
-            },
-            'Script Mods': {
-                'extensions': ['*.ts4script'],
-                'pattern': 'scriptmod_*'
-            },
-            'Build Mode Objects': {
-                'extensions': ['*.package'],
-                'pattern': 'buildmode_*'
-            },
-        },
-        # Add checkboxes
-        for key in self.criteria:
-            checkbox = QCheckBox(key)
-            self.criteria_checkboxes.append(checkbox)
-            self.checkboxes_layout.addWidget(checkbox)
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.setEnabled(False)
+        self.cancel_button.clicked.connect(self.cancel_task)
+        progress_layout.addWidget(self.cancel_button)
+        main_layout.addLayout(progress_layout)
 
-            # Initialize treeview
-            tree_view = self.init_tree_view()
-            layout.addWidget(tree_view)
-
-            self.tree_view.clicked.connect(self.update_criteria_description)
-            # Group related elements
-            sort_group = QGroupBox("Sort Files")
-            sort_group_layout = QVBoxLayout()
-            sort_group_layout.setSpacing(5)
-
-            # Add checkboxes for sorting criteria
-            checkboxes_layout = self.init_checkboxes()
-            sort_group_layout.addLayout(checkboxes_layout)
-
-            self.sort_button = QPushButton("Sort Files")
-            self.sort_button.setToolTip(
-                "Sort files in a selected folder based on specific criteria")
-            self.sort_button.clicked.connect(self.sort_files)
-            sort_group_layout.addWidget(self.sort_button)
-
-            sort_group.setLayout(sort_group_layout)
-            layout.addWidget(sort_group)
-
-            self.edit_custom_criteria_button = QPushButton(
-                "Edit Custom Criteria")
-            self.edit_custom_criteria_button.clicked.connect(
-                self.edit_custom_criteria)
-            layout.addWidget(self.edit_custom_criteria_button)
-
-            self.remove_custom_criteria_button = QPushButton(
-                "Remove Custom Criteria")
-            self.remove_custom_criteria_button.clicked.connect(
-                self.remove_custom_criteria)
-            layout.addWidget(self.remove_custom_criteria_button)
-
-            # Add Extract button
-            self.extract_button = QPushButton("Extract Files")
-            self.extract_button.setToolTip(
-                "Extract selected archive files to a destination folder")
-            self.extract_button.clicked.connect(self.extract_files)
-            layout.addWidget(self.extract_button)
-
-            # Add Undo button
-            self.undo_button = QPushButton("Undo Last Action")
-            self.undo_button.setEnabled(False)
-            self.undo_button.clicked.connect(self.undo_process)
-            layout.addWidget(self.undo_button)
-
-            # Add Undo Specific Folder button
-            self.undo_specific_button = QPushButton("Undo Specific Folder")
-            self.undo_specific_button.setEnabled(False)
-            self.undo_specific_button.clicked.connect(self.undo_process)
-            layout.addWidget(self.undo_specific_button)
-            self.undo_button.setEnabled(bool(self.destination_folders))
-
-            # Initialize status label
-            self.status_label = QLabel()
-            layout.addWidget(self.status_label)
-
-            # Add "Add Criterion" button
-            self.add_criterion_button = QPushButton("Add Criterion")
-            self.add_criterion_button.clicked.connect(
-                self.add_custom_criterion)
-            layout.addWidget(self.add_criterion_button)
-
-            self.setLayout(layout)
-            self.extracted_files = []
-            self.show()
-
-    def move_files(self, source_folder, output_folder):
-        for file in os.listdir(source_folder):
-            file_path = os.path.join(source_folder, file)
-
-            if os.path.isfile(file_path):
-                category = self.categorize_mods(file_path)
-                if category:
-                    destination_folder = os.path.join(output_folder, category)
-                    if not os.path.exists(destination_folder):
-                        os.makedirs(destination_folder)
-
-                shutil.move(file_path, os.path.join(destination_folder, file))
+        self.setLayout(main_layout)
+        self._set_busy(False)
+        self.show()
 
     def init_checkboxes(self):
-        checkboxes_layout = QVBoxLayout()
+        """(Re)build one checkbox per criterion, keeping the ones that were checked"""
+        checked = {checkbox.text()
+                   for checkbox in self.criteria_checkboxes if checkbox.isChecked()}
+        for checkbox in self.criteria_checkboxes:
+            self.checkboxes_layout.removeWidget(checkbox)
+            checkbox.deleteLater()
+        self.criteria_checkboxes = []
 
         for key in self.criteria:
             checkbox = QCheckBox(key)
+            checkbox.setChecked(key in checked)
             self.criteria_checkboxes.append(checkbox)
-            checkboxes_layout.addWidget(checkbox)
-
-        return checkboxes_layout
-
-    def add_criterion(self, name, extensions, pattern, description):
-        self.criteria[name] = {
-            "extensions": extensions,
-            "pattern": pattern,
-            "description": description}
+            self.checkboxes_layout.addWidget(checkbox)
 
     def add_custom_criterion(self):
         dialog = CustomCriteriaDialog(self)
@@ -399,18 +267,6 @@ class Extractor(QWidget):
             # Update checkboxes
             self.init_checkboxes()
 
-    def find_best_group(self, file_name, groups):
-        highest_score = 0
-        best_group = None
-
-        for group_name in groups:
-            score = fuzz.token_set_ratio(file_name, group_name)
-            if score > highest_score:
-                highest_score = score
-                best_group = group_name
-
-        return best_group
-
     def init_tree_view(self):
         self.tree_view = QTreeView()
         self.tree_view.setHeaderHidden(True)
@@ -484,7 +340,7 @@ class Extractor(QWidget):
 
         criterion_name = selected_item.text()
         if criterion_name in self.criteria:
-            description = self.criteria[criterion_name]["description"]
+            description = self.criteria[criterion_name].get("description", "")
         elif criterion_name in self.custom_criteria:
             description = f"Custom criterion with extensions {', '.join(self.custom_criteria[criterion_name]['extensions'])} and pattern {self.custom_criteria[criterion_name]['pattern']}"
         else:
@@ -492,49 +348,23 @@ class Extractor(QWidget):
 
         self.criteria_description_label.setText(description)
 
-    def is_supported_file(self, file_path):
-        supported_extensions = ['.zip', '.tar', '.7z', '.rar']
-        file_extension = os.path.splitext(file_path)[1].lower()
-        return file_extension in supported_extensions
-
-    def is_valid_directory(self, directory):
-        return os.path.isdir(directory)
-
-    def categorize_mods(self, file_path):
-        file_name = os.path.basename(file_path)
-
-        return next(
-            (
-                criterion_name
-                for criterion_name, criterion_data in self.criteria.items()
-                if any(
-                    fnmatch.fnmatch(file_name, pattern)
-                    for pattern in criterion_data["extensions"]
-                )
-                and fnmatch.fnmatch(file_name, criterion_data["pattern"])
-            ),
-            None,
-        )
-
     def extract_files(self):
         options = QFileDialog.Options()
         options |= QFileDialog.ReadOnly
 
         files, _ = QFileDialog.getOpenFileNames(
-            self, "Select archive files to extract", "", "All Files (*);;Zip Files (*.zip);;Tar Files (*.tar);;7z Files (*.7z);;Rar Files (*.rar)", options=options)
+            self, "Select archive files to extract", "", "All Files (*);;Zip Files (*.zip);;Tar Files (*.tar *.tar.gz *.tgz *.tar.bz2 *.tar.xz);;7z Files (*.7z);;Rar Files (*.rar)", options=options)
 
-        valid_files = [f for f in files if self.is_supported_file(f)]
+        kinds = self.archive_detector.detect(files)
+        valid_files = [f for f in files if kinds[f]]
 
         destination = QFileDialog.getExistingDirectory(
             self, "Select folder to extract files")
 
         if valid_files and self.is_valid_directory(destination):
-            try:
-                self._extract_files(valid_files, destination)
-            except Exception as e:
-                QMessageBox.critical(
-                    self, "Error", f"Failed to extract files: {e}")
-                self.status_label.setText("Error: Extraction failed.")
+            criteria = self.criteria if self.sort_on_extract_checkbox.isChecked() else None
+            self.run_in_background(
+                self.extract_archives, self._extract_finished, valid_files, destination, criteria, kinds)
         else:
             if not valid_files:
                 QMessageBox.warning(self, "Invalid Files",
@@ -543,24 +373,60 @@ class Extractor(QWidget):
                 QMessageBox.warning(self, "Invalid Directory",
                                     "Please select a valid destination folder.")
 
-    def extract_files(self, source_folder, output_folder):
-        if not os.path.exists(output_folder):
-            os.makedirs(output_folder)
-
-        for file in os.listdir(source_folder):
-            file_path = os.path.join(source_folder, file)
-
-            if os.path.isfile(file_path):
-                if category := self.categorize_mods(file_path):
-                    destination_folder = os.path.join(output_folder, category)
-                    if not os.path.exists(destination_folder):
-                        os.makedirs(destination_folder)
-
-                    shutil.move(file_path, os.path.join(
-                        destination_folder, file))
+    def _extract_finished(self, results):
+        failed = [result for result in results if result[3] is not None]
+        extracted = [result for result in results if result[3] is None]
+        if failed:
+            archive_path, _, _, error = failed[0]
+            QMessageBox.warning(self, "Extraction Incomplete",
+                                f"{len(failed)} archives could not be extracted, e.g. {os.path.basename(archive_path)}: {error}")
+        details = ", ".join(f"{os.path.basename(archive_path)} {files} files at {rate / 1024 / 1024:.1f} MB/s"
+                            for archive_path, files, rate, _ in extracted[:3])
+        self._update_status(
+            f"Extracted {len(extracted)} archives. {details}")
+
+    def toggle_watch(self, checked):
+        if not checked:
+            if self.folder_watcher is not None:
+                self.folder_watcher.stop()
+                self.folder_watcher = None
+                self._update_status("Stopped watching.")
+            self.watch_button.setText("Watch Folder")
+            return
 
-        QMessageBox.information(self, "Extraction Complete",
-                                "The files have been extracted and sorted successfully.")
+        folder = QFileDialog.getExistingDirectory(
+            self, "Select folder to watch")
+        if not self.is_valid_directory(folder):
+            self.watch_button.setChecked(False)
+            return
+        self.folder_watcher = FolderWatcher(folder, self.files_arrived.emit)
+        self.folder_watcher.start()
+        self.watch_button.setText("Stop Watching")
+        self._update_status(f"Watching {folder} for new files.")
+
+    def _queue_new_files(self, paths):
+        # Batches that arrive while busy are merged and sorted together
+        self.watch_pending.update(dict.fromkeys(paths))
+        self._sort_watched()
+
+    def _sort_watched(self):
+        if self.busy or not self.watch_pending or self.folder_watcher is None:
+            return
+        paths = list(self.watch_pending)
+        self.watch_pending.clear()
+        self.dedupe_on_sort = self.dedupe_checkbox.isChecked()
+        self.run_in_background(self.sort_new_files, self._watch_batch_finished,
+                               paths, self.folder_watcher.folder)
+
+    def _watch_batch_finished(self, result):
+        results, failed = result
+        errors = sum(1 for outcome in results if outcome[3] is not None)
+        message = f"Sorted new files at {datetime.now():%H:%M:%S}"
+        if results:
+            message += f", extracted {len(results) - errors} archives"
+        if errors or failed:
+            message += f", {errors + len(failed)} failed"
+        self._update_status(message + ".")
 
     def add_custom_criteria(self):
         dialog = CustomCriteriaDialog(self)
@@ -577,31 +443,7 @@ class Extractor(QWidget):
                 self, "Custom Criteria Added", f"Custom criteria '{name}' added successfully.")
             self.extracted_files = [(file, destination)]
 
-    def load_custom_criteria(self):
-        with contextlib.suppress(FileNotFoundError):
-            with open("custom_criteria.json", "r") as file:
-                self.custom_criteria = json.load(file)
-
-    def is_matching_pattern(self, file_name, pattern):
-        if "*" in pattern or "?" in pattern:
-            return fnmatch.fnmatch(file_name, pattern)
-        else:
-            return re.match(pattern, file_name)
-
     def sort_files(self):
-
-        for file in os.listdir(source_folder):
-            file_path = os.path.join(source_folder, file)
-
-            if os.path.isfile(file_path):
-                if category := self.categorize_mods(file_path):
-                    destination_folder = os.path.join(output_folder, category)
-                    if not os.path.exists(destination_folder):
-                        os.makedirs(destination_folder)
-
-                    shutil.move(file_path, os.path.join(
-                        destination_folder, file))
-
         # Get the selected criteria based on checked checkboxes
         selected_criteria = {checkbox.text(): self.criteria[checkbox.text()]
                              for checkbox in self.criteria_checkboxes if checkbox.isChecked()}
@@ -615,103 +457,23 @@ class Extractor(QWidget):
             self, "Select folder to sort")
 
         if self.is_valid_directory(folder):
-            self._extracted_from_sort_files_(selected_criteria, folder)
+            self.run_in_background(self.sort_folder, self._sort_finished,
+                                   selected_criteria, folder, self.recursive_checkbox.isChecked())
         else:
             QMessageBox.critical(
                 self, "Error", "Please select a valid folder to sort.")
             self.status_label.setText("Please select a valid folder to sort.")
 
-    # TODO Rename this here and in `sort_files`
-    def _extracted_from_sort_files_(self, selected_criteria, folder):
-        # sourcery skip: low-code-quality
-        original_locations = {
-            name: value
-            for name, value in list(self.__dict__.items())
-            if isinstance(value, Location)
-        }
-        # Define a priority list for sorting
-        priority_list = ["Mods", "Tray", "Archives"]
-
-        # Sort the priority list based on the selected criteria
-        priority_list = [
-            key for key in priority_list if key in selected_criteria]
-
-        # Sort files into subfolders based on names
-        grouped_files = {}
-
-        for entry in Path(folder).glob('*'):
-            if entry.is_file():
-                # Sort by priority, based on the selected criteria
-                for key in priority_list:
-                    if any(ext in entry.suffix for ext in selected_criteria[key]):
-                        group_name = key
-                        break
-                else:
-                    group_name = os.path.splitext(entry.name)[0]
-                # Apply custom criteria
-                for custom_name, custom_criteria in self.custom_criteria.items():
-                    extensions = custom_criteria["extensions"]
-                    pattern = custom_criteria["pattern"]
-
-                    if any(ext in entry.suffix for ext in extensions) or self.is_matching_pattern(entry.name, pattern):
-                        group_name = custom_name
-                        break
-                # Create a new group if it doesn't exist
-                if group_name not in grouped_files:
-                    grouped_files[group_name] = []
-
-                # Find the best group for the current file
-                best_group = self.find_best_group(
-                    entry.name, grouped_files[group_name])
-
-                if not best_group:
-                    best_group = {
-                        "name": group_name,
-                        "files": []
-                    }
-                    grouped_files[group_name].append(best_group)
-
-                best_group["files"].append(entry)
-
-            # Move files to subfolders based on their group
-        for groups in grouped_files.values():
-            for group in groups:
-                destination_folder = os.path.join(folder, group["name"])
-                if not os.path.exists(destination_folder):
-                    os.makedirs(destination_folder)
-
-                for file in group["files"]:
-                    original_locations[str(file)] = folder
-                    shutil.move(str(file), os.path.join(
-                        destination_folder, file.name))
-
-        self.status_label.setText("Files sorted successfully.")
-        self.undo_button.setEnabled(True)
-
-        self.destination_folders.append(original_locations)
-    for file in os.listdir(source_folder):
-        file_path = os.path.join(source_folder, file)
-
-        if os.path.isfile(file_path):
-            category = self.categorize_mods(file_path)
-            if category:
-                destination_folder = os.path.join(output_folder, category)
-                if not os.path.exists(destination_folder):
-                    os.makedirs(destination_folder)
-
-                print(f"Moving file {file} to {destination_folder}")
-                shutil.move(file_path, os.path.join(destination_folder, file))
-
-    def categorize_mods(self, file_path):
-        for category, criterion in self.criteria.items():
-            extensions = criterion['extensions']
-            pattern = criterion['pattern']
-            file_name = os.path.basename(file_path)
-
-            if fnmatch.fnmatch(file_name, pattern) and any(file_name.endswith(ext) for ext in extensions):
-                return category
-
-        return None
+    def _sort_finished(self, result):
+        moved, skipped, failed = result
+        if self.worker.tracker.cancelled.is_set():
+            self._update_status(
+                f"Sort cancelled after {moved} files, which can be undone.")
+        elif failed or skipped:
+            self._update_status(
+                f"Files sorted, {skipped} skipped because the name was already taken, {failed} failed to move.")
+        else:
+            self._update_status("Files sorted successfully.")
 
     def add_custom_criteria(self):
         dialog = CustomCriteriaDialog(self)
@@ -727,74 +489,104 @@ class Extractor(QWidget):
             QMessageBox.information(
                 self, "Custom Criteria Added", f"Custom criteria '{name}' added successfully.")
 
-    def load_custom_criteria(self):
-        with contextlib.suppress(FileNotFoundError):
-            with open("custom_criteria.json", "r") as file:
-                self.custom_criteria = json.load(file)
-
-    def save_custom_criteria(self):
-        with open("custom_criteria.json", "w") as file:
-            json.dump(self.custom_criteria, file)
-
-    def is_matching_pattern(self, file_name, pattern):
-        if "*" in pattern or "?" in pattern:
-            return fnmatch.fnmatch(file_name, pattern)
-        else:
-            return bool(re.match(pattern, file_name))
+    def undo_last(self):
+        self.run_in_background(self.undo_last_batch, self._undo_last_finished)
 
     def undo_process(self):
         folder = QFileDialog.getExistingDirectory(
             self, "Select folder to undo")
 
         if self.is_valid_directory(folder):
-            files_to_undo = []
-            for entry in Path(folder).glob('*'):
-                if entry.is_file():
-                    for extracted_file, extracted_folder in self.extracted_files:
-                        if entry.name == os.path.basename(extracted_file) and extracted_folder == folder:
-                            files_to_undo.append(entry)
-                            if entry in self.extracted_files:
-                                original_file, original_destination = self.extracted_files.pop(
-                                    self.extracted_files.index(entry))
-                                shutil.move(str(entry), original_file)
-                                break
-                    for original_locations in self.destination_folders:
-                        for file_path, original_location in original_locations.items():
-                            if entry.name == Path(file_path).name and Path(original_location).resolve() == Path(folder).resolve():
-                                files_to_undo.append(entry)
-                                if entry in self.extracted_files:
-                                    original_file, original_destination = self.extracted_files.pop(
-                                        self.extracted_files.index(entry))
-                                    shutil.move(str(entry), original_file)
-                                    break
-
-            if not files_to_undo:
-                QMessageBox.critical(
-                    self, "Error", "Selected folder does not contain any files that were extracted or sorted by the app.")
-                self.status_label.setText(
-                    "Selected folder does not contain any files that were extracted or sorted by the app.")
-                return
-
-            try:
-                for entry in files_to_undo:
-                    filename = entry.name
-                    new_location = os.path.join(folder, filename)
-                    shutil.move(str(entry), new_location)
-            except Exception as e:
-                QMessageBox.critical(
-                    self, "Error", f"Failed to undo process: {e}")
-                self.status_label.setText(f"Failed to undo process: {e}")
-                return
-
-            self._update_status("Process undone successfully.")
-            self.destination_folders.pop()
+            self.run_in_background(
+                self.undo_folder, self._undo_folder_finished, folder)
         else:
             QMessageBox.critical(
                 self, "Error", "Please select a valid folder to undo.")
             self.status_label.setText("Please select a valid folder to undo.")
-        self.destination_folders.pop()
-        if not self.destination_folders:
-            self.undo_specific_button.setEnabled(False)
+
+    def _undo_last_finished(self, outcomes):
+        self._undo_finished(
+            outcomes, "The last action left nothing that could be undone.")
+
+    def _undo_folder_finished(self, outcomes):
+        self._undo_finished(
+            outcomes, "Selected folder does not contain any files that were extracted or sorted by the app.")
+
+    def _undo_finished(self, outcomes, nothing_message):
+        if not outcomes:
+            QMessageBox.critical(self, "Error", nothing_message)
+            self._update_status(nothing_message)
+            return
+
+        statuses = collections.Counter(outcome.status for outcome in outcomes)
+        _, _, files_per_second, bytes_per_second, _ = self.worker.tracker.snapshot()
+        message = (f"Restored {statuses['restored']} files and removed {statuses['removed']} extracted files"
+                   f" at {files_per_second:.0f} files/s, {bytes_per_second / 1024 / 1024:.1f} MB/s.")
+        problems = [outcome for outcome in outcomes if outcome.error is not None]
+        if problems:
+            message += (f" Left alone: {statuses['modified']} modified since, {statuses['taken']} with their"
+                        f" original place taken; {statuses['failed']} failed.")
+            QMessageBox.warning(self, "Undo Incomplete",
+                                message + "\n\n" + "\n".join(f"{outcome.path}: {outcome.error}" for outcome in problems[:10]))
+        self._update_status(message)
+
+    def run_in_background(self, task, on_finished, *args):
+        """Run task(*args, progress=...) on a worker thread"""
+        # The previous thread may still be winding down after its signal
+        if self.worker_thread is not None:
+            self.worker_thread.wait()
+        self.worker_thread = QThread()
+        self.worker = TaskWorker(task, *args)
+        self.worker.moveToThread(self.worker_thread)
+        self.worker_thread.started.connect(self.worker.run)
+        self.worker.progress.connect(self._show_progress)
+        # Connected to methods of this widget so they run on the GUI thread
+        for signal in (self.worker.finished, self.worker.failed):
+            signal.connect(self.worker_thread.quit)
+            signal.connect(self._task_done)
+        self.worker.finished.connect(on_finished)
+        self.worker.failed.connect(self._task_failed)
+
+        self._set_busy(True)
+        self.progress_bar.setRange(0, 0)
+        self.status_label.setText("Working...")
+        self.worker_thread.start()
+
+    def cancel_task(self):
+        self.worker.tracker.cancel()
+        self.cancel_button.setEnabled(False)
+        self.status_label.setText("Cancelling, finishing the moves in progress...")
+
+    def _set_busy(self, busy):
+        self.busy = busy
+        has_history = bool(self.journal.batches())
+        self.sort_button.setEnabled(not busy)
+        self.extract_button.setEnabled(not busy)
+        self.undo_button.setEnabled(not busy and has_history)
+        self.undo_specific_button.setEnabled(not busy and has_history)
+        self.cancel_button.setEnabled(busy)
+        self.progress_bar.setVisible(busy)
+
+    def _task_done(self, *_):
+        self._set_busy(False)
+        # After the task's own finished handler, which reads self.worker
+        QTimer.singleShot(0, self._sort_watched)
+
+    def _show_progress(self, files, total_files, files_per_second, bytes_per_second, eta):
+        if total_files >= 0:
+            self.progress_bar.setRange(0, max(total_files, 1))
+            self.progress_bar.setValue(min(files, total_files))
+        else:
+            # A busy indicator while the total is unknown
+            self.progress_bar.setRange(0, 0)
+        message = f"{files} files, {files_per_second:.0f} files/s, {bytes_per_second / 1024 / 1024:.1f} MB/s"
+        if eta >= 0:
+            message += f", about {eta:.0f} s left"
+        self.status_label.setText(message)
+
+    def _task_failed(self, message):
+        QMessageBox.critical(self, "Error", f"Operation failed: {message}")
+        self._update_status(f"Error: {message}")
 
     def _update_status(self, message):
         self.status_label.setText(message)
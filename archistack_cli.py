@@ -0,0 +1,264 @@
+"""Sort, extract and undo from the command line, without starting the GUI
+
+    python -m archistack_cli sort FOLDER [--recursive] [--criterion NAME ...]
+    python -m archistack_cli plan FOLDER --output PLAN [--recursive] [--criterion NAME ...]
+    python -m archistack_cli apply PLAN
+    python -m archistack_cli extract ARCHIVE ... --to FOLDER [--sort]
+    python -m archistack_cli undo [--folder FOLDER | --list | --replay BATCH]
+    python -m archistack_cli scan FOLDER [--recursive]
+    python -m archistack_cli dupes FOLDER [--recursive]
+    python -m archistack_cli scripts FOLDER [--recursive]
+
+Uses the built-in categories plus custom_criteria.json in the working
+directory, and shares the scan index and undo journal with the GUI.
+"""
+import argparse
+import collections
+import itertools
+import os
+import sys
+
+from archistack_core import (ExtractorCore, FileHasher, MovePlan, Progress, find_duplicates, inspect_scripts,
+                             scan_folder, script_conflicts, walk_folder)
+
+
+def print_progress(files, total_files, files_per_second, bytes_per_second, eta):
+    total = "" if total_files is None else f"/{total_files}"
+    print(f"\r{files}{total} files, {files_per_second:.0f} files/s, {bytes_per_second / 1024 / 1024:.1f} MB/s",
+          end="", file=sys.stderr, flush=True)
+
+
+def run(args, task, *task_args):
+    """Run a core task with progress on stderr unless --quiet"""
+    progress = Progress(None if args.quiet else print_progress)
+    result = task(*task_args, progress=progress)
+    if not args.quiet:
+        progress.report()
+        print(file=sys.stderr)
+    return result
+
+
+def selected_criteria(core, args):
+    if unknown := set(args.criterion) - set(core.criteria):
+        raise SystemExit(f"Unknown criteria: {', '.join(sorted(unknown))}")
+    if not os.path.isdir(args.folder):
+        raise SystemExit(f"Not a folder: {args.folder}")
+    return {name: core.criteria[name] for name in args.criterion or core.criteria}
+
+
+def sort(core, args):
+    moved, skipped, failed = run(args, core.sort_folder,
+                                 selected_criteria(core, args), args.folder, args.recursive)
+    print(f"Moved {moved} files, {skipped} skipped because the name was already taken, {failed} failed to move.")
+    return 1 if failed else 0
+
+
+def plan(core, args):
+    """Save what sort would do, and print the files and bytes per folder"""
+    move_plan = run(args, core.plan_sort,
+                    selected_criteria(core, args), args.folder, args.recursive)
+    move_plan.save(args.output)
+    for category, (files, size) in sorted(move_plan.totals().items()):
+        print(f"{category}\t{files}\t{size}")
+    print(f"{len(move_plan)} files to move, {move_plan.skipped} skipped because the name was already taken.",
+          file=sys.stderr)
+    return 0
+
+
+def apply(core, args):
+    moved, skipped, failed = run(
+        args, core.execute_plan, MovePlan.load(args.plan))
+    print(f"Moved {moved} files, {skipped} skipped because they changed since planning, {failed} failed to move.")
+    return 1 if failed else 0
+
+
+def extract(core, args):
+    if not os.path.isdir(args.to):
+        raise SystemExit(f"Not a folder: {args.to}")
+
+    kinds = core.archive_detector.detect(args.archives)
+    for path in args.archives:
+        if not kinds[path]:
+            print(f"Skipping {path}: not a supported archive", file=sys.stderr)
+    archives = [path for path in args.archives if kinds[path]]
+    if not archives:
+        return 1
+
+    criteria = core.criteria if args.sort else None
+    results = run(args, core.extract_archives,
+                  archives, args.to, criteria, kinds)
+    for archive_path, files, rate, error in results:
+        if error is None:
+            print(f"{archive_path}: {files} files at {rate / 1024 / 1024:.1f} MB/s")
+        else:
+            print(f"{archive_path}: failed after {files} files: {error}", file=sys.stderr)
+    return 1 if any(result[3] is not None for result in results) else 0
+
+
+def undo(core, args):
+    if args.list:
+        for batch_id in core.journal.batches():
+            print(batch_id)
+        for batch_id in core.journal.batches("undone"):
+            print(f"{batch_id} (undone)")
+        return 0
+
+    if args.replay:
+        try:
+            redone, errors = core.journal.replay(args.replay)
+        except FileNotFoundError:
+            raise SystemExit(f"No undone batch called {args.replay}")
+        for error in errors:
+            print(error, file=sys.stderr)
+        print(f"Redid {redone} moves, {len(errors)} failed.")
+        return 1 if errors else 0
+
+    if args.folder:
+        outcomes = run(args, core.undo_folder, args.folder)
+    else:
+        outcomes = run(args, core.undo_last_batch)
+    statuses = collections.Counter(outcome.status for outcome in outcomes)
+    for outcome in outcomes:
+        if outcome.error is not None:
+            print(f"{outcome.status}: {outcome.path}: {outcome.error}", file=sys.stderr)
+    print(f"Restored {statuses['restored']} files and removed {statuses['removed']} extracted files; "
+          f"{statuses['modified']} modified since, {statuses['taken']} with their original place taken, "
+          f"{statuses['failed']} failed.")
+    return 1 if any(outcome.error is not None for outcome in outcomes) else 0
+
+
+def scan(core, args):
+    """Print category, archive type and path for every file, tab separated"""
+    if not os.path.isdir(args.folder):
+        raise SystemExit(f"Not a folder: {args.folder}")
+
+    entries = walk_folder(args.folder) if args.recursive else scan_folder(args.folder)
+    while chunk := list(itertools.islice(entries, core.sort_chunk_size)):
+        paths = [entry.path for entry in chunk]
+        kinds = core.archive_detector.detect(paths)
+        categories = core.categorize_files(paths)
+        for path in paths:
+            print(f"{categories[path] or '-'}\t{kinds[path] or '-'}\t{path}")
+    return 0
+
+
+def dupes(core, args):
+    """Print each set of identical files, one path per line, blank line between"""
+    if not os.path.isdir(args.folder):
+        raise SystemExit(f"Not a folder: {args.folder}")
+
+    entries = walk_folder(args.folder) if args.recursive else scan_folder(args.folder)
+    groups = find_duplicates([entry.path for entry in entries],
+                             FileHasher(core.scan_index))
+    wasted = 0
+    for group in groups:
+        wasted += os.path.getsize(group[0]) * (len(group) - 1)
+        print("\n".join(sorted(group)), end="\n\n")
+    print(f"{len(groups)} sets of duplicates, {wasted / 1024 / 1024:.1f} MB in extra copies.",
+          file=sys.stderr)
+    return 0
+
+
+def scripts(core, args):
+    """Print root package and path of every script mod, then the module conflicts"""
+    if not os.path.isdir(args.folder):
+        raise SystemExit(f"Not a folder: {args.folder}")
+
+    entries = walk_folder(args.folder) if args.recursive else scan_folder(args.folder)
+    mods = [mod for mod in inspect_scripts([entry.path for entry in entries
+                                            if entry.name.lower().endswith(".ts4script")])
+            if mod.modules]
+    for mod in sorted(mods, key=lambda mod: (mod.root, mod.path)):
+        print(f"{mod.root}\t{len(mod.modules)}\t{mod.path}")
+    conflicts = script_conflicts(mods)
+    for module, paths in sorted(conflicts.items()):
+        print(f"{module} is in {', '.join(sorted(paths))}", file=sys.stderr)
+    print(f"{len(mods)} script mods from {len({mod.root for mod in mods})} creators, "
+          f"{len(conflicts)} conflicting modules.", file=sys.stderr)
+    return 1 if conflicts else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="archistack", description="Sort, extract and undo without the GUI.")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="don't report progress on stderr")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    sort_parser = commands.add_parser(
+        "sort", help="sort a folder into group folders")
+    sort_parser.add_argument("folder")
+    sort_parser.add_argument("-r", "--recursive", action="store_true",
+                             help="also sort files in nested folders")
+    sort_parser.add_argument("-c", "--criterion", action="append", default=[],
+                             help="sort by this category only; repeat for more (default: all)")
+    sort_parser.set_defaults(handler=sort)
+
+    plan_parser = commands.add_parser(
+        "plan", help="work out a sort without moving anything")
+    plan_parser.add_argument("folder")
+    plan_parser.add_argument("-o", "--output", required=True,
+                             help="file to save the plan to")
+    plan_parser.add_argument("-r", "--recursive", action="store_true",
+                             help="also sort files in nested folders")
+    plan_parser.add_argument("-c", "--criterion", action="append", default=[],
+                             help="sort by this category only; repeat for more (default: all)")
+    plan_parser.set_defaults(handler=plan)
+
+    apply_parser = commands.add_parser(
+        "apply", help="carry out a saved plan")
+    apply_parser.add_argument("plan")
+    apply_parser.set_defaults(handler=apply)
+
+    extract_parser = commands.add_parser(
+        "extract", help="extract archives into a folder")
+    extract_parser.add_argument("archives", nargs="+")
+    extract_parser.add_argument("-t", "--to", required=True,
+                                help="folder to extract into")
+    extract_parser.add_argument("-s", "--sort", action="store_true",
+                                help="write members straight into category folders")
+    extract_parser.set_defaults(handler=extract)
+
+    undo_parser = commands.add_parser(
+        "undo", help="undo the last sort or extraction")
+    undo_options = undo_parser.add_mutually_exclusive_group()
+    undo_options.add_argument("-f", "--folder",
+                              help="only put back the files now in this folder, from any batch")
+    undo_options.add_argument("-l", "--list", action="store_true",
+                              help="list the journaled batches")
+    undo_options.add_argument("--replay", metavar="BATCH",
+                              help="redo the moves of an undone batch")
+    undo_parser.set_defaults(handler=undo)
+
+    scan_parser = commands.add_parser(
+        "scan", help="show how each file in a folder would be categorized")
+    scan_parser.add_argument("folder")
+    scan_parser.add_argument("-r", "--recursive", action="store_true",
+                             help="include nested folders")
+    scan_parser.set_defaults(handler=scan)
+
+    dupes_parser = commands.add_parser(
+        "dupes", help="list files in a folder with identical contents")
+    dupes_parser.add_argument("folder")
+    dupes_parser.add_argument("-r", "--recursive", action="store_true",
+                              help="include nested folders")
+    dupes_parser.set_defaults(handler=dupes)
+
+    scripts_parser = commands.add_parser(
+        "scripts", help="list script mods by creator and find conflicting modules")
+    scripts_parser.add_argument("folder")
+    scripts_parser.add_argument("-r", "--recursive", action="store_true",
+                                help="include nested folders")
+    scripts_parser.set_defaults(handler=scripts)
+
+    args = parser.parse_args(argv)
+    core = ExtractorCore()
+    core.criteria = dict(core.categories)
+    try:
+        return args.handler(core, args)
+    except KeyboardInterrupt:
+        return 130
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,2567 @@
+"""ArchiStack's sorting, extraction and undo, free of any GUI code
+
+Archistack.py builds its window on top of ExtractorCore, and
+archistack_cli.py drives it from the command line. Nothing here imports
+PyQt5, and the slower optional libraries are imported where they are used.
+"""
+import array
+import base64
+import bz2
+import collections
+import concurrent.futures
+import contextlib
+from datetime import datetime
+import errno
+import fnmatch
+import functools
+import gzip
+import hashlib
+import heapq
+import itertools
+import json
+import lzma
+import mmap
+import multiprocessing
+import os
+import queue
+import re
+import shutil
+import sqlite3
+import struct
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+from rapidfuzz import fuzz, process
+from rapidfuzz.utils import default_process
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    # Watch mode polls the folder instead
+    FileSystemEventHandler = object
+    Observer = None
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_pattern(pattern):
+    """Classify a custom criteria pattern as glob or regex and compile it once"""
+    if "*" in pattern or "?" in pattern:
+        return True, re.compile(fnmatch.translate(os.path.normcase(pattern)))
+    return False, re.compile(pattern)
+
+
+class ScanEntry:
+    """A file found by scan_folder, built from the directory listing alone"""
+
+    __slots__ = ("name", "path", "suffix", "_dir_entry")
+
+    def __init__(self, dir_entry):
+        self.name = dir_entry.name
+        self.path = dir_entry.path
+        self.suffix = os.path.splitext(dir_entry.name)[1]
+        self._dir_entry = dir_entry
+
+    def __fspath__(self):
+        return self.path
+
+    def __str__(self):
+        return self.path
+
+    # Free on Windows; on other platforms the first access costs one stat
+    # that os.DirEntry then caches
+    @property
+    def size(self):
+        return self._dir_entry.stat().st_size
+
+    @property
+    def mtime(self):
+        return self._dir_entry.stat().st_mtime
+
+    @property
+    def mtime_ns(self):
+        return self._dir_entry.stat().st_mtime_ns
+
+
+def path_key(path):
+    return os.path.normcase(os.path.abspath(path))
+
+
+def same_path(first, second):
+    return path_key(first) == path_key(second)
+
+
+# (offset, magic bytes, kind), checked in order against the start of a file
+ARCHIVE_SIGNATURES = [
+    (0, b"PK\x03\x04", "zip"),
+    (0, b"PK\x05\x06", "zip"),
+    (0, b"Rar!\x1a\x07", "rar"),
+    (0, b"7z\xbc\xaf\x27\x1c", "7z"),
+    (0, b"\x1f\x8b", "gz"),
+    (0, b"BZh", "bz2"),
+    (0, b"\xfd7zXZ\x00", "xz"),
+    (257, b"ustar", "tar"),
+]
+SNIFF_SIZE = 512
+
+
+def sniff_kind(head):
+    """Identify an archive from its first bytes; None if it isn't one
+
+    Compressed tars (.tar.gz, .tgz, ...) are reported as "tar" when the
+    start of the compressed stream holds a tar header.
+    """
+    for offset, magic, kind in ARCHIVE_SIGNATURES:
+        if head[offset:offset + len(magic)] == magic:
+            break
+    else:
+        return None
+    decompressor = {"gz": lambda: zlib.decompressobj(zlib.MAX_WBITS | 16),
+                    "bz2": bz2.BZ2Decompressor,
+                    "xz": lzma.LZMADecompressor}.get(kind)
+    if decompressor:
+        # A truncated stream is expected here, take whatever came out
+        with contextlib.suppress(Exception):
+            if decompressor().decompress(head)[257:262] == b"ustar":
+                return "tar"
+    return kind
+
+
+def sniff_archive(file_path):
+    try:
+        with open(file_path, "rb") as file:
+            return sniff_kind(file.read(SNIFF_SIZE))
+    except OSError:
+        return None
+
+
+class ArchiveDetector:
+    """Content-based archive detection, cached per (path, size, mtime)"""
+
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+        # path -> (size, mtime_ns, kind)
+        self.cache = {}
+
+    def detect(self, paths):
+        """Return {path: kind or None}, reading only files not seen as they are"""
+        kinds = {}
+        unseen = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                kinds[path] = None
+                continue
+            key = (stat.st_size, stat.st_mtime_ns)
+            cached = self.cache.get(path)
+            if cached and cached[:2] == key:
+                kinds[path] = cached[2]
+            else:
+                unseen.append((path, key))
+
+        if unseen:
+            # The reads are tiny, so overlap their latency instead of their bytes
+            with concurrent.futures.ThreadPoolExecutor(min(self.max_workers, len(unseen))) as pool:
+                for (path, key), kind in zip(unseen, pool.map(sniff_archive, (path for path, _ in unseen))):
+                    self.cache[path] = (*key, kind)
+                    kinds[path] = kind
+        return kinds
+
+
+def kind_from_name(file_name):
+    name = file_name.lower()
+    if name.endswith((".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")):
+        return "tar"
+    return {".zip": "zip", ".ts4script": "zip", ".rar": "rar",
+            ".7z": "7z", ".tar": "tar"}.get(os.path.splitext(name)[1])
+
+
+def is_archive_name(file_name):
+    """Whether a name says archive, not a format that merely is one
+
+    .ts4script is a zip the game reads as is, and office documents, jars and
+    apks sniff as zips too; none of them may be unpacked automatically.
+    """
+    return kind_from_name(file_name) is not None and not file_name.lower().endswith(".ts4script")
+
+
+def open_archive(archive_path, file=None, kind=None):
+    """Open a zip or rar through their shared member API, or return None
+
+    file is an already open file object to read instead of archive_path.
+    kind is what sniff_kind found; without it the name decides.
+    """
+    kind = kind or kind_from_name(archive_path)
+    if kind == "zip":
+        return zipfile.ZipFile(file or archive_path)
+    if kind == "rar":
+        import rarfile
+        return rarfile.RarFile(file or archive_path)
+    return None
+
+
+def is_nested_archive(member_name):
+    return os.path.splitext(member_name)[1].lower() in (".zip", ".rar")
+
+
+def format_size(size):
+    if size < 1024 * 1024:
+        return f"{size} bytes"
+    return f"{size / 1024 / 1024:.1f} MB"
+
+
+class ArchiveBudgetError(Exception):
+    """An archive would expand past its depth, size or member budget"""
+
+
+class ExpansionBudget:
+    """What one archive, nested archives included, may expand to"""
+
+    def __init__(self, max_depth=3, max_bytes=16 * 1024 ** 3, max_members=100_000, spool_size=64 * 1024 * 1024):
+        self.max_depth = max_depth
+        self.max_bytes = max_bytes
+        self.max_members = max_members
+        # Inner archives up to this size are expanded from memory
+        self.spool_size = spool_size
+        self.bytes = 0
+        self.members = 0
+
+    def share(self, declared, nested_chunk=0):
+        """Split this budget between the chunks of one archive
+
+        declared is (bytes, members) for each chunk, as its members declare
+        them. Each chunk gets exactly its declared share, and the chunk at
+        nested_chunk, which must hold every nested archive, also gets all
+        that is left for them to expand into. So how many chunks an archive
+        is split into never decides whether it fits. Returns None when the
+        declared sizes alone are over budget.
+        """
+        total_bytes = sum(size for size, _ in declared)
+        total_members = sum(members for _, members in declared)
+        if total_bytes > self.max_bytes or total_members > self.max_members:
+            return None
+        budgets = [ExpansionBudget(self.max_depth, size, members, self.spool_size)
+                   for size, members in declared]
+        budgets[nested_chunk].max_bytes += self.max_bytes - total_bytes
+        budgets[nested_chunk].max_members += self.max_members - total_members
+        return budgets
+
+    def charge(self, size, members=1):
+        """Count members more members and size more bytes, before they are written"""
+        self.members += members
+        self.bytes += size
+        if self.members > self.max_members:
+            raise ArchiveBudgetError(
+                f"more than {self.max_members} members")
+        if self.bytes > self.max_bytes:
+            raise ArchiveBudgetError(
+                f"more than {format_size(self.max_bytes)} expanded")
+
+
+@contextlib.contextmanager
+def open_nested(archive, member, spool_size):
+    """Open an archive stored inside another, in memory when it's small"""
+    with tempfile.SpooledTemporaryFile(max_size=spool_size) as spool:
+        with archive.open(member) as source:
+            shutil.copyfileobj(source, spool, 1024 * 1024)
+        spool.seek(0)
+        with open_archive(member.filename, spool) as nested:
+            yield nested
+
+
+class BudgetedReader:
+    """A file object that charges a budget for every byte read through it"""
+
+    def __init__(self, file, budget):
+        self.file = file
+        self.budget = budget
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.budget.charge(len(data), members=0)
+        return data
+
+
+def parse_7z_listing(listing):
+    """The size of every file in the output of 7z l -slt"""
+    sizes = []
+    # Entries follow the dashed line, one block of "Key = value" lines each
+    _, _, entries = listing.partition("\n----------\n")
+    for block in entries.split("\n\n"):
+        fields = dict(line.split(" = ", 1)
+                      for line in block.splitlines() if " = " in line)
+        if "Path" not in fields or fields.get("Folder") == "+" or fields.get("Attributes", "").startswith("D"):
+            continue
+        sizes.append(int(fields.get("Size") or 0))
+    return sizes
+
+
+def declared_sizes(archive_path):
+    """The file sizes 7-Zip lists for an archive, without unpacking it
+
+    None when no 7-Zip program is installed or it can't list the archive.
+    """
+    program = next(
+        (path for path in map(shutil.which, ("7z", "7za", "7zr")) if path), None)
+    if program is None:
+        return None
+    try:
+        listing = subprocess.run([program, "l", "-slt", archive_path], capture_output=True,
+                                 check=True, text=True, errors="replace").stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return parse_7z_listing(listing)
+
+
+def safe_relative_path(member_name):
+    parts = [part.replace(":", "_") for part in member_name.replace("\\", "/").split("/")
+             if part not in ("", ".", "..")]
+    return os.path.join(*parts) if parts else "_"
+
+
+def categorized_path(member_name, destination, matcher):
+    """Where a member goes when sorting while extracting, or None to keep its path"""
+    if matcher is None:
+        return None
+    name = os.path.basename(member_name.replace("\\", "/"))
+    if category := matcher.match(name):
+        return os.path.join(destination, category, name)
+    return None
+
+
+class DirectoryCache:
+    """Folders known to exist, so each is checked or created at most once"""
+
+    def __init__(self):
+        self.known = set()
+
+    def ensure(self, folder):
+        if folder not in self.known:
+            os.makedirs(folder, exist_ok=True)
+            self.known.add(folder)
+
+    def ensure_all(self, folders):
+        """Create every folder up front, before the moves that need them"""
+        for folder in set(folders) - self.known:
+            self.ensure(folder)
+
+
+def free_names(target):
+    """target, then "name (1).ext", "name (2).ext" and so on beside it"""
+    yield target
+    stem, extension = os.path.splitext(target)
+    for number in itertools.count(1):
+        yield f"{stem} ({number}){extension}"
+
+
+def open_for_writing(target):
+    """Create target, or the first free name beside it; returns (file, path)
+
+    Files are created exclusively, so nothing already there is replaced,
+    whether it was on disk before or another worker just wrote it.
+    """
+    for candidate in free_names(target):
+        try:
+            return open(candidate, "xb"), candidate
+        except FileExistsError:
+            continue
+        except FileNotFoundError:
+            # The folder nearly always exists already, so only look when it doesn't
+            os.makedirs(os.path.dirname(candidate), exist_ok=True)
+            with contextlib.suppress(FileExistsError):
+                return open(candidate, "xb"), candidate
+
+
+def stream_to(source, target):
+    """Write source to target or a free name beside it; returns the path written"""
+    output, target = open_for_writing(target)
+    try:
+        with output:
+            shutil.copyfileobj(source, output, 1024 * 1024)
+    except BaseException:
+        # A partial file was never produced
+        with contextlib.suppress(OSError):
+            os.unlink(target)
+        raise
+    return target
+
+
+def place_file(source, target):
+    """Move a staged file to target or a free name beside it; returns the path"""
+    for candidate in free_names(target):
+        try:
+            os.link(source, candidate)
+        except FileExistsError:
+            continue
+        except OSError:
+            # No hard links on this filesystem
+            with open(source, "rb") as staged:
+                return stream_to(staged, candidate)
+        return candidate
+
+
+def plan_members(archive, destination, matcher):
+    """Yield (member, target or None) for every file in a zip or rar
+
+    destination is where the category folders go.
+    """
+    taken = set()
+    for member in archive.infolist():
+        if member.is_dir():
+            continue
+        target = categorized_path(member.filename, destination, matcher)
+        if target is not None:
+            if os.path.normcase(target) in taken:
+                target = None
+            else:
+                taken.add(os.path.normcase(target))
+        yield member, target
+
+
+def extract_member(archive, member, destination, target):
+    # Streamed rather than archive.extract(), which checks the folder of
+    # every member before writing it
+    target = target or os.path.join(
+        destination, safe_relative_path(member.filename))
+    with archive.open(member) as source:
+        return stream_to(source, target)
+
+
+def expand_member(archive, member, target, destination, category_root, matcher, budget, produced, depth=0):
+    """Extract one member, expanding it instead if it is itself an archive
+
+    Appends what it writes to produced and returns the bytes written.
+    """
+    # zipfile never reads past the declared size, so it can be trusted
+    budget.charge(member.file_size)
+    if depth >= budget.max_depth or not is_nested_archive(member.filename):
+        produced.append(extract_member(archive, member, destination, target))
+        return member.file_size
+
+    # Inner files land where the inner archive would have been extracted
+    nested_destination = os.path.join(
+        destination, os.path.splitext(safe_relative_path(member.filename))[0])
+    size = 0
+    with open_nested(archive, member, budget.spool_size) as nested:
+        for nested_member, nested_target in list(plan_members(nested, category_root, matcher)):
+            size += expand_member(nested, nested_member, nested_target, nested_destination,
+                                  category_root, matcher, budget, produced, depth + 1)
+    return size
+
+
+def split_members(plan, chunks):
+    """Split (member, target) pairs into chunks of about equal total size"""
+    bins = [(0, index, []) for index in range(chunks)]
+    # Biggest first onto the lightest chunk keeps the chunks balanced
+    for member, target in sorted(plan, key=lambda item: item[0].file_size, reverse=True):
+        load, index, items = heapq.heappop(bins)
+        items.append((member.filename, target))
+        heapq.heappush(bins, (load + member.file_size, index, items))
+    return [items for _, _, items in sorted(bins, key=lambda item: item[1]) if items]
+
+
+def extract_members(archive_path, destination, members, criteria=None, budget=None):
+    """Extract some members of a zip with this process's own file handle
+
+    members is a list of (member name, target or None) from split_members.
+    Returns the same tuple as extract_archive.
+    """
+    started = time.monotonic()
+    matcher = CriteriaMatcher(criteria) if criteria else None
+    budget = budget or ExpansionBudget()
+    produced = []
+    size = 0
+    error = None
+    with zipfile.ZipFile(archive_path) as archive:
+        try:
+            for name, target in members:
+                size += expand_member(archive, archive.getinfo(name), target, destination,
+                                      destination, matcher, budget, produced)
+        except (ArchiveBudgetError, OSError) as e:
+            error = e
+    return archive_path, produced, size, time.monotonic() - started, error
+
+
+def extract_archive(archive_path, destination, criteria=None, budget=None, kind=None):
+    """Extract one archive into destination; runs in a worker process
+
+    With criteria, members are classified by name before they are read and
+    written straight into their category folder, so nothing is moved later.
+    Zips and rars inside a zip or rar are expanded in place, within budget.
+    7z and other pyunpack formats are held to the budget by their 7-Zip
+    listing before anything is unpacked; with no 7-Zip program to list them
+    they are only checked once unpacked, so they can still fill the disk.
+    kind is the archive's sniffed type, read from the file when not given.
+    Returns (archive_path, files produced, bytes written, seconds taken,
+    error); error is an ArchiveBudgetError if the budget ran out part way,
+    or the OSError that stopped extraction, and produced still lists what
+    was written before it.
+    """
+    started = time.monotonic()
+    kind = kind or sniff_archive(archive_path) or kind_from_name(archive_path)
+    matcher = CriteriaMatcher(criteria) if criteria else None
+    budget = budget or ExpansionBudget()
+    produced = []
+    size = 0
+    error = None
+
+    archive = open_archive(archive_path, kind=kind)
+    if archive is not None:
+        with archive:
+            try:
+                for member, target in list(plan_members(archive, destination, matcher)):
+                    size += expand_member(archive, member, target, destination,
+                                          destination, matcher, budget, produced)
+            except (ArchiveBudgetError, OSError) as e:
+                error = e
+    elif kind == "tar":
+        # tarfile sees through gzip, bzip2 and xz on its own. Members are
+        # streamed like zip members rather than extractall()ed, which
+        # replaces files already there
+        with tarfile.open(archive_path) as archive:
+            try:
+                for member in archive:
+                    if not member.isfile():
+                        continue
+                    # Nor does tarfile past the header's size
+                    budget.charge(member.size)
+                    target = categorized_path(member.name, destination, matcher) or os.path.join(
+                        destination, safe_relative_path(member.name))
+                    with archive.extractfile(member) as source:
+                        produced.append(stream_to(source, target))
+                    size += member.size
+            except (ArchiveBudgetError, tarfile.TarError, OSError) as e:
+                error = e
+    elif kind in ("gz", "bz2", "xz"):
+        # A single compressed file, decompressed here so the budget sees
+        # every byte as it comes out
+        opener = {"gz": gzip.open, "bz2": bz2.open, "xz": lzma.open}[kind]
+        name = os.path.splitext(os.path.basename(archive_path))[0]
+        target = categorized_path(name, destination, matcher) or os.path.join(
+            destination, name)
+        try:
+            budget.charge(0)
+            with opener(archive_path) as source:
+                produced.append(stream_to(
+                    BudgetedReader(source, budget), target))
+            size += os.path.getsize(produced[-1])
+        except (ArchiveBudgetError, EOFError, OSError, lzma.LZMAError) as e:
+            error = e
+    else:
+        # 7z and the rest go through pyunpack, which only unpacks whole
+        # archives into a folder, so first refuse archives whose listing
+        # declares more than the budget allows
+        try:
+            declared = declared_sizes(archive_path)
+            for member_size in declared or ():
+                budget.charge(member_size)
+        except ArchiveBudgetError as e:
+            error = e
+        else:
+            size, error = unpack_staged(
+                archive_path, destination, matcher, budget, declared is None, produced)
+
+    return archive_path, produced, size, time.monotonic() - started, error
+
+
+def unpack_staged(archive_path, destination, matcher, budget, charge, produced):
+    """Unpack with pyunpack into a private folder, then link the files into place
+
+    Without a 7-Zip listing (charge true) the budget is only checked as the
+    staged files are placed, after the whole archive is on disk; these
+    formats are not protected from filling it. Returns (bytes, error).
+    """
+    from pyunpack import Archive
+
+    size = 0
+    error = None
+    staging = tempfile.mkdtemp(dir=destination)
+    folders = DirectoryCache()
+    try:
+        Archive(archive_path).extractall(staging)
+        for root, _, files in os.walk(staging):
+            for name in files:
+                source = os.path.join(root, name)
+                source_size = os.path.getsize(source)
+                if charge:
+                    budget.charge(source_size)
+                relative_path = os.path.relpath(source, staging)
+                target = categorized_path(relative_path, destination, matcher) or os.path.join(
+                    destination, relative_path)
+                folders.ensure(os.path.dirname(target))
+                produced.append(place_file(source, target))
+                size += source_size
+    except ArchiveBudgetError as e:
+        error = e
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    return size, error
+
+
+def walk_folder(folder):
+    """Yield the files in folder and all of its subfolders, one at a time"""
+    pending = [folder]
+    while pending:
+        current = pending.pop()
+        with contextlib.suppress(OSError), os.scandir(current) as entries:
+            for dir_entry in entries:
+                with contextlib.suppress(OSError):
+                    if dir_entry.is_dir(follow_symlinks=False):
+                        pending.append(dir_entry.path)
+                    elif dir_entry.is_file():
+                        yield ScanEntry(dir_entry)
+
+
+def scan_folder(folder):
+    """Yield the files directly inside folder without stat-ing each entry"""
+    with os.scandir(folder) as entries:
+        for dir_entry in entries:
+            # is_file() answers from the cached d_type on most filesystems
+            with contextlib.suppress(OSError):
+                if dir_entry.is_file():
+                    yield ScanEntry(dir_entry)
+
+
+class _WatchHandler(FileSystemEventHandler):
+    """Forwards watchdog file events to a FolderWatcher"""
+
+    def __init__(self, watcher):
+        super().__init__()
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        if event.is_directory:
+            return
+        if event.event_type in ("created", "modified", "closed"):
+            self.watcher.notify(event.src_path)
+        elif event.event_type == "moved":
+            self.watcher.notify(event.dest_path)
+
+
+class FolderWatcher:
+    """Hands new files in one folder to on_batch once they stop changing
+
+    Uses watchdog (inotify on Linux) when it is installed and polls the
+    folder otherwise. Events wait in a bounded queue; if a burst overflows
+    it, the folder is rescanned for recent files instead, so none are lost.
+    on_batch is called on the watcher's own thread.
+    """
+
+    # Browsers and download managers rename these once the file is complete
+    partial_suffixes = (".part", ".partial", ".crdownload", ".download", ".tmp")
+
+    def __init__(self, folder, on_batch, debounce=2.0, batch_size=500, max_queued=10_000, poll_interval=2.0):
+        self.folder = folder
+        self.on_batch = on_batch
+        # Seconds a file must go without events before it is handed on
+        self.debounce = debounce
+        self.batch_size = batch_size
+        self.max_queued = max_queued
+        self.poll_interval = poll_interval
+        self.events = queue.Queue(max_queued)
+        self.overflowed = threading.Event()
+        self.stopped = threading.Event()
+        self.started_ns = time.time_ns()
+        self.observer = None
+        self.threads = []
+
+    def notify(self, path):
+        if path.lower().endswith(self.partial_suffixes):
+            return
+        try:
+            self.events.put_nowait(path)
+        except queue.Full:
+            self.overflowed.set()
+
+    def start(self):
+        if Observer is not None:
+            self.observer = Observer()
+            self.observer.schedule(_WatchHandler(
+                self), self.folder, recursive=False)
+            self.observer.start()
+        else:
+            self._spawn(self._poll)
+        self._spawn(self._collect)
+
+    def stop(self):
+        self.stopped.set()
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+        for thread in self.threads:
+            thread.join()
+
+    def _spawn(self, target):
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def _snapshot(self):
+        snapshot = {}
+        with contextlib.suppress(OSError):
+            for entry in scan_folder(self.folder):
+                with contextlib.suppress(OSError):
+                    snapshot[entry.path] = (entry.size, entry.mtime_ns)
+        return snapshot
+
+    def _poll(self):
+        # Files already there when watching starts are not new
+        previous = self._snapshot()
+        while not self.stopped.wait(self.poll_interval):
+            current = self._snapshot()
+            for path, state in current.items():
+                if previous.get(path) != state:
+                    self.notify(path)
+            previous = current
+
+    def _collect(self):
+        # Path -> when its last event arrived
+        pending = {}
+        while not self.stopped.is_set():
+            with contextlib.suppress(queue.Empty):
+                path = self.events.get(timeout=min(self.debounce, 0.5))
+                now = time.monotonic()
+                pending[path] = now
+                # Past this, leave events queued so the queue can overflow
+                while len(pending) < self.max_queued:
+                    pending[self.events.get_nowait()] = now
+
+            if self.overflowed.is_set():
+                self.overflowed.clear()
+                now = time.monotonic()
+                for path, (_, mtime_ns) in self._snapshot().items():
+                    if mtime_ns >= self.started_ns and not path.lower().endswith(self.partial_suffixes):
+                        pending[path] = now
+
+            now = time.monotonic()
+            ready = [path for path, changed in pending.items()
+                     if now - changed >= self.debounce]
+            for path in ready:
+                del pending[path]
+            ready = [path for path in ready if os.path.isfile(path)]
+            for start in range(0, len(ready), self.batch_size):
+                self.on_batch(ready[start:start + self.batch_size])
+
+
+class Progress:
+    """Thread-safe progress counters with throttled reporting and cancellation"""
+
+    def __init__(self, callback=None, interval=0.25):
+        # callback(files, total_files, files_per_second, bytes_per_second, eta)
+        self.callback = callback
+        self.interval = interval
+        self.total_files = None
+        self.files = 0
+        self.bytes = 0
+        self.cancelled = threading.Event()
+        self._started = time.monotonic()
+        self._last_report = 0
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def advance(self, files=1, size=0):
+        with self._lock:
+            self.files += files
+            self.bytes += size
+            now = time.monotonic()
+            if now - self._last_report < self.interval:
+                return
+            self._last_report = now
+        self.report()
+
+    def snapshot(self):
+        elapsed = max(time.monotonic() - self._started, 1e-6)
+        files_per_second = self.files / elapsed
+        eta = None
+        if self.total_files is not None and files_per_second:
+            eta = max(self.total_files - self.files, 0) / files_per_second
+        return self.files, self.total_files, files_per_second, self.bytes / elapsed, eta
+
+    def report(self):
+        if self.callback:
+            self.callback(*self.snapshot())
+
+
+MoveResult = collections.namedtuple(
+    "MoveResult", ["source", "destination", "error"])
+
+
+class MoveExecutor:
+    """Run planned (source, destination) moves on a thread pool
+
+    At most per_device_limit moves touch any one filesystem at a time, so a
+    slow network share can't hog every worker.
+    """
+
+    copy_buffer_size = 8 * 1024 * 1024
+
+    def __init__(self, max_workers=8, per_device_limit=4, fsync=False):
+        self.max_workers = max_workers
+        self.per_device_limit = per_device_limit
+        # fsync copied files before deleting the source on another device
+        self.fsync = fsync
+        # How many moves were a plain rename and how many needed a copy
+        self.counters = collections.Counter()
+        self._device_limits = {}
+        self._lock = threading.Lock()
+
+    def _device(self, path, devices=None):
+        # One stat per folder, not per file, while devices lives; run()
+        # passes a fresh dict so mounts that change between runs are seen
+        folder = os.path.dirname(os.path.abspath(path))
+        if devices is not None:
+            with contextlib.suppress(KeyError):
+                return devices[folder]
+        try:
+            device = os.stat(folder).st_dev
+        except OSError:
+            # Not cached, the folder may exist by the next move
+            return None
+        if devices is not None:
+            devices[folder] = device
+        return device
+
+    def _device_limit(self, device):
+        with self._lock:
+            if device not in self._device_limits:
+                self._device_limits[device] = threading.BoundedSemaphore(
+                    self.per_device_limit)
+            return self._device_limits[device]
+
+    def _count(self, path):
+        with self._lock:
+            self.counters[path] += 1
+
+    def _copy_data(self, source_file, destination_file):
+        source_fd = source_file.fileno()
+        destination_fd = destination_file.fileno()
+        # Let the kernel move the bytes when it can, falling back to a
+        # large-buffer copy through user space
+        kernel_copies = []
+        if hasattr(os, "copy_file_range"):
+            kernel_copies.append(lambda: os.copy_file_range(
+                source_fd, destination_fd, self.copy_buffer_size))
+        if hasattr(os, "sendfile"):
+            kernel_copies.append(lambda: os.sendfile(
+                destination_fd, source_fd, None, self.copy_buffer_size))
+
+        for copy_chunk in kernel_copies:
+            try:
+                while copy_chunk():
+                    pass
+                return
+            except OSError:
+                # Not supported between these filesystems, start over
+                os.lseek(source_fd, 0, os.SEEK_SET)
+                os.lseek(destination_fd, 0, os.SEEK_SET)
+                os.ftruncate(destination_fd, 0)
+        shutil.copyfileobj(source_file, destination_file,
+                           self.copy_buffer_size)
+
+    def _copy_and_unlink(self, source, destination):
+        with open(source, "rb") as source_file:
+            # Opened exclusively, so a file already there is never touched
+            destination_file = open(destination, "xb")
+            try:
+                with destination_file:
+                    self._copy_data(source_file, destination_file)
+                    if self.fsync:
+                        destination_file.flush()
+                        os.fsync(destination_file.fileno())
+                shutil.copystat(source, destination)
+            except BaseException:
+                with contextlib.suppress(OSError):
+                    os.unlink(destination)
+                raise
+        os.unlink(source)
+
+    def _rename(self, source, destination):
+        """Rename without ever replacing an existing destination
+
+        os.rename replaces silently on POSIX, so link the new name first,
+        which fails atomically if it is taken, then drop the old one.
+        """
+        if same_path(source, destination):
+            # Only the case of the name changes
+            os.rename(source, destination)
+            return
+        # A link to a symlink would point at its target instead
+        if not os.path.islink(source):
+            try:
+                os.link(source, destination)
+            except FileExistsError:
+                raise
+            except OSError as e:
+                # Else no hard links on this filesystem, rename below
+                if e.errno == errno.EXDEV:
+                    raise
+            else:
+                os.unlink(source)
+                return
+        with self._lock:
+            if os.path.lexists(destination):
+                raise FileExistsError(
+                    errno.EEXIST, "Destination already exists", destination)
+            os.rename(source, destination)
+
+    def move_file(self, source, destination, same_device=None):
+        """Move one file with a rename when possible, else copy and unlink
+
+        Raises FileExistsError instead of replacing a file at destination.
+        """
+        if same_device is None:
+            same_device = self._device(source) == self._device(destination)
+        if same_device:
+            try:
+                self._rename(source, destination)
+                self._count("rename")
+                return
+            except OSError as e:
+                # Bind mounts and the like share st_dev but not a filesystem
+                if e.errno != errno.EXDEV:
+                    raise
+        self._copy_and_unlink(source, destination)
+        self._count("copy")
+
+    def _move(self, source, destination, devices):
+        source_device = self._device(source, devices)
+        destination_device = self._device(destination, devices)
+        # Always acquire in the same order so two cross-device moves can't
+        # deadlock on each other's filesystems
+        devices = sorted({source_device, destination_device}, key=str)
+        limits = [self._device_limit(device) for device in devices]
+        for limit in limits:
+            limit.acquire()
+        try:
+            self.move_file(source, destination, source_device ==
+                           destination_device and source_device is not None)
+        except OSError as e:
+            return MoveResult(source, destination, e)
+        finally:
+            for limit in reversed(limits):
+                limit.release()
+        return MoveResult(source, destination, None)
+
+    def run(self, moves, cancelled=None):
+        """Yield a MoveResult for every move, in the order they finish
+
+        Once the cancelled event is set no new moves start, but the ones
+        already running finish and are reported.
+        """
+        devices = {}
+        with concurrent.futures.ThreadPoolExecutor(self.max_workers) as pool:
+            pending = set()
+            for source, destination in moves:
+                if cancelled is not None and cancelled.is_set():
+                    break
+                pending.add(pool.submit(self._move, source, destination, devices))
+                # Keep the queue short so a streamed plan stays streamed
+                if len(pending) >= self.max_workers * 4:
+                    done, pending = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+            for future in concurrent.futures.as_completed(pending):
+                yield future.result()
+
+
+class CriteriaMatcher:
+    """Compiled form of a criteria dict, built once and reused for every file"""
+
+    def __init__(self, criteria):
+        self.criteria = criteria
+        self.categories = []
+        # Suffix (e.g. '.package') -> indexes of the categories that accept it
+        self.suffix_index = {}
+        # Categories with extension globs that can't be keyed by suffix
+        self.wildcard_categories = []
+        self._bucket_regexes = {}
+
+        for category, criterion in criteria.items():
+            extensions = [self._extension_glob(ext)
+                          for ext in criterion["extensions"] if ext]
+            if not extensions:
+                continue
+
+            index = len(self.categories)
+            name_regex = fnmatch.translate(
+                os.path.normcase(criterion["pattern"]))
+            extension_regex = "|".join(fnmatch.translate(
+                os.path.normcase(ext)) for ext in extensions)
+            self.categories.append(
+                (category, f"(?={name_regex})(?:{extension_regex})"))
+
+            suffixes = [self._literal_suffix(ext) for ext in extensions]
+            if None in suffixes:
+                self.wildcard_categories.append(index)
+                continue
+            for suffix in set(suffixes):
+                self.suffix_index.setdefault(suffix, []).append(index)
+
+    @staticmethod
+    def _extension_glob(extension):
+        # Plain extensions such as '.txt' from the custom criteria dialog
+        if not any(char in extension for char in "*?["):
+            return f"*{extension}"
+        return extension
+
+    @staticmethod
+    def _literal_suffix(extension_glob):
+        literal = os.path.normcase(extension_glob[1:])
+        if not extension_glob.startswith("*") or not literal.startswith(".") or any(char in literal for char in "*?["):
+            return None
+        return literal[literal.rfind("."):]
+
+    def _bucket_regex(self, suffix):
+        with contextlib.suppress(KeyError):
+            return self._bucket_regexes[suffix]
+
+        indexes = sorted(self.suffix_index.get(
+            suffix, []) + self.wildcard_categories)
+        regex = None
+        if indexes:
+            # Alternatives are tried in order, so the first match is the
+            # same category a linear scan over the criteria would return
+            regex = re.compile("|".join(
+                f"(?P<c{index}>{self.categories[index][1]})" for index in indexes))
+        self._bucket_regexes[suffix] = regex
+        return regex
+
+    def match(self, file_name):
+        file_name = os.path.normcase(file_name)
+        dot = file_name.rfind(".")
+        suffix = file_name[dot:] if dot >= 0 else ""
+        regex = self._bucket_regex(
+            suffix if suffix in self.suffix_index else None)
+        if regex is None:
+            return None
+
+        if match := regex.match(file_name):
+            return self.categories[int(match.lastgroup[1:])][0]
+        return None
+
+
+class GroupIndex:
+    """Groups of similar file names, indexed by their normalized name tokens"""
+
+    # Scores assign() holds at once, as float32
+    assign_block_cells = 1 << 22
+
+    def __init__(self):
+        self.groups = []
+        self._names = []
+        # Token -> positions of the groups whose name contains it
+        self._token_index = {}
+        # Length of the joined token set -> positions of the groups
+        self._length_index = {}
+
+    def __iter__(self):
+        return iter(self.groups)
+
+    def __len__(self):
+        return len(self.groups)
+
+    def add(self, group):
+        position = len(self.groups)
+        name = default_process(group["name"])
+        tokens = sorted(set(name.split()))
+
+        self.groups.append(group)
+        self._names.append(name)
+        for token in tokens:
+            self._token_index.setdefault(token, []).append(position)
+        self._length_index.setdefault(
+            len(" ".join(tokens)), []).append(position)
+
+    def best(self, file_name, threshold=0):
+        """Return the same group as scoring every group in order, or None"""
+        name = default_process(file_name)
+        tokens = sorted(set(name.split()))
+        best_position = None
+        best_score = threshold
+
+        def consider(position):
+            nonlocal best_position, best_score
+            score = fuzz.token_set_ratio(name, self._names[position])
+            # Ties go to the oldest group, like the linear scan did
+            if score > best_score or (score == best_score and best_position is not None and position < best_position):
+                best_position = position
+                best_score = score
+
+        candidates = set()
+        for token in tokens:
+            candidates.update(self._token_index.get(token, ()))
+        for position in sorted(candidates):
+            consider(position)
+
+        # Without a shared token the score is the plain ratio of the joined
+        # token sets, which can't beat 200 * shorter / (sum of lengths)
+        length = len(" ".join(tokens))
+        for other_length, positions in self._length_index.items():
+            if length + other_length == 0 or 200 * min(length, other_length) / (length + other_length) < best_score:
+                continue
+            for position in positions:
+                if position not in candidates:
+                    consider(position)
+
+        return None if best_position is None else self.groups[best_position]
+
+    def assign(self, file_names, group_name, threshold=0):
+        """Group a whole listing at once, returning one group per file name
+
+        Gives the same result as calling best() for each file in order and
+        adding a new group called group_name whenever nothing scores above
+        the threshold. Files are scored a block of rows at a time, so memory
+        stays bounded however long the listing is.
+        """
+        if not file_names:
+            return []
+        # numpy alone takes longer to import than the command line may
+        import numpy
+
+        # Groups sharing a name always score the same and ties go to the
+        # oldest, so only the first group of each name can ever win
+        first_positions = {}
+        for position, name in enumerate(self._names):
+            first_positions.setdefault(name, position)
+        columns = list(first_positions)
+        new_name = default_process(group_name)
+        # The group_name column only becomes a candidate once the first
+        # miss against the existing groups has created that group
+        new_column = None
+        if new_name not in first_positions:
+            new_column = len(columns)
+            columns.append(new_name)
+        column_groups = [self.groups[first_positions[name]]
+                         for name in columns if name in first_positions]
+        column_index = _ColumnIndex(columns)
+
+        names = [default_process(file_name) for file_name in file_names]
+        block_rows = max(1, self.assign_block_cells // len(columns))
+        assigned = []
+        for start in range(0, len(names), block_rows):
+            scores = column_index.scores(
+                names[start:start + block_rows], threshold)
+            rows = numpy.arange(len(scores))
+            best_columns = scores.argmax(axis=1)
+            hits = scores[rows, best_columns] > threshold
+
+            if new_column is not None:
+                if new_column:
+                    existing_columns = scores[:, :new_column].argmax(axis=1)
+                    existing_hits = scores[rows, existing_columns] > threshold
+                else:
+                    existing_columns = numpy.zeros(len(scores), dtype=int)
+                    existing_hits = numpy.zeros(len(scores), dtype=bool)
+                first_miss = int(existing_hits.argmin()) if not existing_hits.all() else len(
+                    scores)
+                best_columns[:first_miss + 1] = existing_columns[:first_miss + 1]
+                hits[:first_miss + 1] = existing_hits[:first_miss + 1]
+
+            for column, hit in zip(best_columns.tolist(), hits.tolist()):
+                if hit:
+                    assigned.append(column_groups[column])
+                    continue
+                group = {"name": group_name, "files": []}
+                self.add(group)
+                if new_column is not None:
+                    column_groups.append(group)
+                    new_column = None
+                assigned.append(group)
+        return assigned
+
+
+class _ColumnIndex:
+    """Distinct group names for GroupIndex.assign, indexed like GroupIndex"""
+
+    def __init__(self, columns):
+        self.columns = columns
+        # Token -> (column positions, their names)
+        self.token_columns = {}
+        # Length of the joined token set -> (column positions, their names)
+        self.length_columns = {}
+        for position, name in enumerate(columns):
+            tokens = sorted(set(name.split()))
+            for token in tokens:
+                self._add(self.token_columns, token, position)
+            self._add(self.length_columns,
+                      len(" ".join(tokens)), position)
+
+    def _add(self, index, key, position):
+        positions, names = index.setdefault(key, ([], []))
+        positions.append(position)
+        names.append(self.columns[position])
+
+    def scores(self, names, threshold):
+        """token_set_ratio of names against every column, as a float32 array
+
+        Pairs that can't reach the row's best score are left at 0 without
+        being scored, by the same shared-token and length bounds as best().
+        Scores at or under the threshold may be 0 as well.
+        """
+        import numpy
+
+        def score(rows, columns, column_names):
+            scores[numpy.ix_(rows, columns)] = process.cdist(
+                [names[row] for row in rows], column_names, scorer=fuzz.token_set_ratio,
+                dtype=numpy.float32, score_cutoff=threshold, workers=-1)
+
+        scores = numpy.zeros((len(names), len(self.columns)), dtype=numpy.float32)
+        token_rows = {}
+        lengths = numpy.empty(len(names))
+        for row, name in enumerate(names):
+            tokens = sorted(set(name.split()))
+            lengths[row] = len(" ".join(tokens))
+            for token in tokens:
+                if token in self.token_columns:
+                    token_rows.setdefault(token, []).append(row)
+        for token, rows in token_rows.items():
+            score(rows, *self.token_columns[token])
+
+        # Without a shared token the score can't beat 200 * shorter / (sum
+        # of lengths); the margin covers rounding the best score to float32
+        best = numpy.maximum(scores.max(axis=1), threshold) - 0.001
+        for other_length, (columns, column_names) in self.length_columns.items():
+            total = lengths + other_length
+            bound = 200 * numpy.minimum(lengths, other_length) / numpy.maximum(total, 1)
+            if len(rows := numpy.flatnonzero((total > 0) & (bound >= best))):
+                score(rows.tolist(), columns, column_names)
+        return scores
+
+
+def criteria_fingerprint(*criteria):
+    """A short hash that changes whenever any of the criteria do"""
+    return hashlib.sha1(json.dumps(criteria, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class ScanIndex:
+    """What each file was classified as, kept on disk between runs
+
+    Rows are keyed by path. One is only trusted while the file has the same
+    size and mtime and was classified under the same criteria fingerprint,
+    so editing the criteria invalidates every row at once.
+    """
+
+    def __init__(self, path="scan_index.sqlite"):
+        self.path = path
+        self.connection = None
+        # Sorting runs on a worker thread, the GUI may read in between
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(
+                self.path, check_same_thread=False)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, fingerprint TEXT, label TEXT)")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS hashes (device INTEGER, inode INTEGER, kind TEXT, size INTEGER, mtime_ns INTEGER, digest TEXT, PRIMARY KEY (device, inode, kind))")
+        return self.connection
+
+    def lookup(self, entries, fingerprint):
+        """Return {path: label} for the entries whose row is still valid"""
+        by_key = {path_key(entry.path): entry for entry in entries}
+        keys = list(by_key)
+        known = {}
+        with self.lock:
+            connection = self._connect()
+            # Stay under SQLite's default limit on bound parameters
+            for start in range(0, len(keys), 900):
+                batch = keys[start:start + 900]
+                rows = connection.execute(
+                    f"SELECT path, size, mtime_ns, label FROM entries WHERE fingerprint = ? AND path IN ({', '.join('?' * len(batch))})",
+                    [fingerprint, *batch])
+                for key, size, mtime_ns, label in rows:
+                    entry = by_key[key]
+                    with contextlib.suppress(OSError):
+                        if entry.size == size and entry.mtime_ns == mtime_ns:
+                            known[entry.path] = label
+        return known
+
+    def update(self, rows, fingerprint, forget=()):
+        """Store (path, size, mtime_ns, label) rows and drop the forget paths"""
+        with self.lock:
+            connection = self._connect()
+            with connection:
+                connection.executemany("DELETE FROM entries WHERE path = ?",
+                                       ((path_key(path),) for path in forget))
+                connection.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                                       ((path_key(path), size, mtime_ns, fingerprint, label)
+                                        for path, size, mtime_ns, label in rows))
+
+    def lookup_hashes(self, stats, kind):
+        """Return {index: digest} for the stats whose file is unchanged"""
+        known = {}
+        with self.lock:
+            connection = self._connect()
+            for index, stat in enumerate(stats):
+                row = connection.execute(
+                    "SELECT digest FROM hashes WHERE device = ? AND inode = ? AND kind = ? AND size = ? AND mtime_ns = ?",
+                    (stat.st_dev, stat.st_ino, kind, stat.st_size, stat.st_mtime_ns)).fetchone()
+                if row is not None:
+                    known[index] = row[0]
+        return known
+
+    def update_hashes(self, rows, kind):
+        """Store (stat, digest) rows"""
+        with self.lock:
+            connection = self._connect()
+            with connection:
+                connection.executemany("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)",
+                                       ((stat.st_dev, stat.st_ino, kind, stat.st_size, stat.st_mtime_ns, digest)
+                                        for stat, digest in rows))
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+
+HASH_SAMPLE = 64 * 1024
+
+
+def hash_sample(path):
+    """BLAKE2 of the first and last 64 KB, which covers small files whole"""
+    digest = hashlib.blake2b()
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size <= 2 * HASH_SAMPLE:
+            digest.update(file.read())
+        else:
+            digest.update(file.read(HASH_SAMPLE))
+            file.seek(-HASH_SAMPLE, os.SEEK_END)
+            digest.update(file.read(HASH_SAMPLE))
+    return digest.hexdigest()
+
+
+def hash_file(path):
+    """BLAKE2 of the whole file, mapped rather than read"""
+    digest = hashlib.blake2b()
+    with open(path, "rb") as file:
+        # An empty file can't be mapped
+        if os.fstat(file.fileno()).st_size:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                digest.update(view)
+    return digest.hexdigest()
+
+
+class FileHasher:
+    """Content hashes, remembered in a ScanIndex by inode, size and mtime"""
+
+    def __init__(self, scan_index=None, max_workers=8):
+        self.scan_index = scan_index
+        self.max_workers = max_workers
+
+    def hashes(self, paths, kind="full"):
+        """Return {path: digest} of kind "sample" or "full", leaving out unreadable files"""
+        stats = []
+        for path in paths:
+            with contextlib.suppress(OSError):
+                stats.append((path, os.stat(path)))
+        known = {}
+        if self.scan_index is not None:
+            known = self.scan_index.lookup_hashes(
+                [stat for _, stat in stats], kind)
+        digests = {stats[index][0]: digest for index, digest in known.items()}
+
+        missing = [item for index, item in enumerate(stats) if index not in known]
+        hasher = hash_sample if kind == "sample" else hash_file
+        computed = []
+        if missing:
+            # hashlib lets go of the GIL on large buffers, so threads overlap
+            with concurrent.futures.ThreadPoolExecutor(min(self.max_workers, len(missing))) as pool:
+                futures = {pool.submit(hasher, path): (path, stat)
+                           for path, stat in missing}
+                for future in concurrent.futures.as_completed(futures):
+                    path, stat = futures[future]
+                    with contextlib.suppress(OSError):
+                        digests[path] = future.result()
+                        computed.append((stat, digests[path]))
+        if computed and self.scan_index is not None:
+            self.scan_index.update_hashes(computed, kind)
+        return digests
+
+
+def find_duplicates(paths, hasher=None):
+    """Group the paths with identical contents; returns lists of two or more
+
+    Only files of equal size are hashed at all, first by their first and
+    last 64 KB, and only those still alike are then hashed in full. Hard
+    links to one file count once.
+    """
+    hasher = hasher or FileHasher()
+    by_size = {}
+    seen = set()
+    for path in paths:
+        with contextlib.suppress(OSError):
+            stat = os.stat(path)
+            if (stat.st_dev, stat.st_ino) not in seen:
+                seen.add((stat.st_dev, stat.st_ino))
+                by_size.setdefault(stat.st_size, []).append(path)
+    groups = [(size, group) for size, group in by_size.items() if len(group) > 1]
+
+    def regroup(groups, kind):
+        digests = hasher.hashes(
+            [path for _, group in groups for path in group], kind)
+        regrouped = []
+        for size, group in groups:
+            by_digest = {}
+            for path in group:
+                if (digest := digests.get(path)) is not None:
+                    by_digest.setdefault(digest, []).append(path)
+            regrouped += [(size, alike)
+                          for alike in by_digest.values() if len(alike) > 1]
+        return regrouped
+
+    groups = regroup(groups, "sample")
+    # The sample already covered the small files from end to end
+    duplicates = [group for size, group in groups if size <= 2 * HASH_SAMPLE]
+    duplicates += [group for _, group in regroup(
+        [(size, group) for size, group in groups if size > 2 * HASH_SAMPLE], "full")]
+    return duplicates
+
+
+class PackageError(Exception):
+    """A .package file isn't a DBPF package this reader understands"""
+
+
+# Magic, major and minor version, entry count, index offset as 32 bits,
+# index size, index offset as 64 bits
+DBPF_HEADER = struct.Struct("<4sII24xIII16xQ24x")
+
+# Resource type IDs in a Sims 4 .package index, by the category they make
+# a package; the first category with a type present wins
+DBPF_CONTENT = {
+    "Custom Content": {
+        0x034AEECB,  # CAS part
+        0x015A1849,  # body geometry
+        0xEAA32ADD,  # CAS preset
+        0x0355E0A6,  # bone delta
+        0xC5F6763E,  # sim modifier
+        0xB6C8B6A0,  # deformer map
+    },
+    "Build Mode Objects": {
+        0xC0DB5AE7,  # object definition
+        0x319E4F1D,  # object catalog
+        0xD5F0F921,  # wall
+        0xB4F762C9,  # floor
+        0x9A20CD1C,  # stairs
+        0x1C1CF1F7,  # railing
+        0x0418FE2A,  # fence
+        0x2FAE983E,  # foundation
+        0x3F0C529A,  # spandrel
+        0xA057811C,  # frieze
+    },
+    "Sims 4 Mods": {
+        0x03B33DDF,  # tuning
+        0x62E94D38,  # combined tuning
+        0x545AC67A,  # SimData
+        0x6017E896,  # buff
+        0xCB5FDDC7,  # trait
+        0xE882D22F,  # interaction
+        0x0C772E27,  # loot
+        0x7DF2169C,  # snippet
+    },
+}
+
+
+def _index_types(index, count, flags, offset):
+    """Resource types from the entries of a DBPF index, walked one by one"""
+    types = collections.Counter()
+    constant_type = None
+    if flags & 1:
+        constant_type, = struct.unpack_from("<I", index, 4)
+    for _ in range(count):
+        # Type, group and instance high, unless constant for the whole index
+        if constant_type is None:
+            types[struct.unpack_from("<I", index, offset)[0]] += 1
+        else:
+            types[constant_type] += 1
+        offset += 4 * (3 - bin(flags & 7).count("1"))
+        # Instance low, position, compressed size, memory size
+        file_size, = struct.unpack_from("<I", index, offset + 8)
+        offset += 16
+        # Compression type and committed flag when the size's top bit is set
+        if file_size & 0x80000000:
+            offset += 4
+    return types
+
+
+def read_package_types(path):
+    """Count the resource type IDs in a DBPF .package
+
+    Only the 96-byte header and the index table are read, never the
+    resources themselves.
+    """
+    with open(path, "rb") as file:
+        header = file.read(DBPF_HEADER.size)
+        if len(header) < DBPF_HEADER.size or header[:4] != b"DBPF":
+            raise PackageError(f"{path} is not a DBPF package")
+        _, major, _, count, position_low, index_size, position = DBPF_HEADER.unpack(
+            header)
+        if major != 2:
+            raise PackageError(f"{path} is DBPF version {major}, not 2")
+        if not count:
+            return collections.Counter()
+        file.seek(position or position_low)
+        index = file.read(index_size)
+
+    if len(index) < 4:
+        raise PackageError(f"{path} has a truncated index")
+    flags, = struct.unpack_from("<I", index)
+    constants = bin(flags & 7).count("1")
+    offset = 4 + 4 * constants
+
+    # The game always sets the compression fields, which makes every entry
+    # the same size; then the types can be sliced out without a loop
+    words = 3 - constants + 5
+    if len(index) - offset == 4 * words * count:
+        entries = array.array("I", index[offset:])
+        if sys.byteorder == "big":
+            entries.byteswap()
+        if all(size & 0x80000000 for size in entries[3 - constants + 2::words]):
+            if flags & 1:
+                return collections.Counter({struct.unpack_from("<I", index, 4)[0]: count})
+            return collections.Counter(entries[::words])
+    try:
+        return _index_types(index, count, flags, offset)
+    except struct.error:
+        raise PackageError(f"{path} has a truncated index") from None
+
+
+def package_category(path, content=DBPF_CONTENT):
+    """The content category of a .package by its resource types, or None"""
+    try:
+        types = read_package_types(path)
+    except (OSError, PackageError):
+        return None
+    for category, type_ids in content.items():
+        if not type_ids.isdisjoint(types):
+            return category
+    return None
+
+
+# The category a .ts4script holding Python modules goes to
+SCRIPT_CATEGORY = "Script Mods"
+
+
+class ScriptMod:
+    """The modules a .ts4script provides, as listed in its zip directory"""
+
+    def __init__(self, path, modules):
+        self.path = path
+        self.modules = modules
+
+    @property
+    def root(self):
+        """The top-level package most modules live in, usually the creator's"""
+        roots = collections.Counter(module.split(".")[0]
+                                    for module in self.modules)
+        return roots.most_common(1)[0][0] if roots else None
+
+
+def inspect_script(path):
+    """Read the module names of a .ts4script without extracting anything
+
+    Opening the zip only reads its central directory, so no member is
+    decompressed.
+    """
+    with zipfile.ZipFile(path) as archive:
+        names = archive.namelist()
+    modules = set()
+    for name in names:
+        stem, extension = os.path.splitext(name)
+        if extension.lower() not in (".py", ".pyc"):
+            continue
+        parts = [part for part in stem.split("/")
+                 if part and part != "__pycache__"]
+        # foo/__init__.pyc is the package foo; foo.cpython-37.pyc is foo
+        if parts and parts[-1] == "__init__":
+            parts.pop()
+        elif parts:
+            parts[-1] = parts[-1].split(".")[0]
+        if parts:
+            modules.add(".".join(parts))
+    return ScriptMod(path, sorted(modules))
+
+
+def inspect_scripts(paths, max_workers=8):
+    """ScriptMods for the readable zips among paths, in order"""
+    def inspect(path):
+        try:
+            return inspect_script(path)
+        except (OSError, zipfile.BadZipFile):
+            return None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+        return [mod for mod in pool.map(inspect, paths) if mod is not None]
+
+
+def script_conflicts(mods):
+    """Return {module: paths} for modules more than one script mod provides
+
+    Only one of them can be imported, so the others are silently shadowed.
+    """
+    providers = {}
+    for mod in mods:
+        for module in mod.modules:
+            providers.setdefault(module, []).append(mod.path)
+    return {module: paths for module, paths in providers.items() if len(paths) > 1}
+
+
+class PackageClassifier:
+    """Categorizes .package files by what their index says is inside"""
+
+    def __init__(self, content=DBPF_CONTENT, max_workers=8):
+        self.content = content
+        self.max_workers = max_workers
+
+    def classify(self, paths):
+        """Return {path: category or None} for the .package files among paths"""
+        packages = [path for path in paths
+                    if path.lower().endswith(".package")]
+        if len(packages) < 2:
+            return {path: package_category(path, self.content) for path in packages}
+        # Header and index reads are small, so overlap their latency
+        with concurrent.futures.ThreadPoolExecutor(min(self.max_workers, len(packages))) as pool:
+            return dict(zip(packages, pool.map(
+                functools.partial(package_category, content=self.content), packages)))
+
+
+class JournalBatch:
+    """The records of one batch, appended to its file a chunk at a time"""
+
+    def __init__(self, batch_id, path):
+        self.batch_id = batch_id
+        self.path = path
+        self.pending = []
+
+    def record(self, op, source, destination, size, mtime_ns):
+        # Absolute, so undo finds them whatever directory it runs from
+        if source is not None:
+            source = os.path.abspath(source)
+        self.pending.append(json.dumps(
+            [op, source, os.path.abspath(destination), size, mtime_ns]) + "\n")
+
+    def sync(self):
+        """Append the pending records and wait until they are on disk"""
+        if not self.pending:
+            return
+        with open(self.path, "a", encoding="utf-8") as file:
+            file.writelines(self.pending)
+            file.flush()
+            os.fsync(file.fileno())
+        self.pending.clear()
+
+
+class UndoJournal:
+    """Append-only, on-disk record of what each sort or extraction did
+
+    Every batch is a file of JSON lines [op, source, destination, size,
+    mtime_ns]; op is "move", or "create" for extracted files, which have no
+    source. Moves are journaled before they start, one fsync per chunk, so
+    a crash never leaves a moved file the journal doesn't know about.
+    Undo streams a batch back from disk rather than holding it in memory.
+    """
+
+    def __init__(self, folder="undo_journal"):
+        self.folder = folder
+        # Batch id -> (bytes indexed, destination folder key -> record offsets)
+        self._indexes = {}
+
+    def _path(self, batch_id, state="log"):
+        return os.path.join(self.folder, f"{batch_id}.{state}")
+
+    def begin(self, kind):
+        os.makedirs(self.folder, exist_ok=True)
+        # Ids sort by time, so the newest batch is listed last
+        batch_id = f"{datetime.now():%Y%m%d-%H%M%S-%f}-{kind}"
+        return JournalBatch(batch_id, self._path(batch_id))
+
+    def batches(self, state="log"):
+        """Ids of the batches that can be undone, or redone, oldest first"""
+        with contextlib.suppress(FileNotFoundError):
+            return sorted(name[:-len(state) - 1] for name in os.listdir(self.folder)
+                          if name.endswith(f".{state}"))
+        return []
+
+    def records(self, batch_id, state="log"):
+        with open(self._path(batch_id, state), encoding="utf-8") as file:
+            for line in file:
+                # A crash can cut the last record short
+                with contextlib.suppress(ValueError):
+                    yield json.loads(line)
+
+    def folder_records(self, batch_id, folder):
+        """Yield only the batch's records whose destination is directly in folder"""
+        path = self._path(batch_id)
+        offsets = self._folder_index(batch_id, path).get(path_key(folder))
+        if not offsets:
+            return
+        with open(path, "rb") as file:
+            for offset in offsets:
+                file.seek(offset)
+                with contextlib.suppress(ValueError):
+                    yield json.loads(file.readline())
+
+    def _folder_index(self, batch_id, path):
+        """Offsets of a batch's records by destination folder
+
+        Built by one pass over the batch the first time it is needed, then
+        extended from where it stopped whenever the batch has grown.
+        """
+        indexed, index = self._indexes.get(batch_id, (0, {}))
+        if os.path.getsize(path) > indexed:
+            with open(path, "rb") as file:
+                file.seek(indexed)
+                # Stop at a record cut short; it is picked up once complete
+                while (line := file.readline()).endswith(b"\n"):
+                    with contextlib.suppress(ValueError):
+                        destination = json.loads(line)[2]
+                        index.setdefault(path_key(os.path.dirname(destination)),
+                                         array.array("q")).append(indexed)
+                    indexed += len(line)
+            self._indexes[batch_id] = (indexed, index)
+        return index
+
+    def retire(self, batch_id):
+        """Mark a fully undone batch, keeping it around for replay"""
+        os.replace(self._path(batch_id), self._path(batch_id, "undone"))
+        self._indexes.pop(batch_id, None)
+
+    def replay(self, batch_id):
+        """Redo the moves of an undone batch; returns (moves redone, errors)
+
+        Extracted files were deleted by the undo, so only moves come back.
+        """
+        redone = 0
+        errors = []
+        for record in self.records(batch_id, "undone"):
+            try:
+                redone += replay_record(*record)
+            except OSError as e:
+                errors.append(e)
+        if not errors:
+            os.replace(self._path(batch_id, "undone"), self._path(batch_id))
+        return redone, errors
+
+
+def _check_unchanged(path, size, mtime_ns):
+    """False if path is gone; raises if it is no longer the journaled file"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return False
+    if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+        raise OSError(f"{path} has changed since it was journaled")
+    return True
+
+
+# status is "restored", "removed" (an extracted file), "modified" or
+# "taken" (conflicts, left alone) or "failed"
+UndoOutcome = collections.namedtuple(
+    "UndoOutcome", ["path", "original", "status", "error"])
+
+
+def plan_revert(records):
+    """Check a chunk of journal records against the disk before undoing any
+
+    Returns (moves, removals, conflicts): reverse moves as (current path,
+    original path, size), extracted files to delete, and an UndoOutcome for
+    every file that changed or whose original place is taken. Records with
+    nothing left to undo, already undone or never moved, are dropped.
+    """
+    moves = []
+    removals = []
+    conflicts = []
+    claimed = set()
+    for op, source, destination, size, mtime_ns in records:
+        try:
+            if not _check_unchanged(destination, size, mtime_ns):
+                continue
+        except OSError as e:
+            conflicts.append(UndoOutcome(destination, source, "modified", e))
+            continue
+        if op == "create":
+            removals.append(destination)
+        elif path_key(source) in claimed or os.path.lexists(source):
+            conflicts.append(UndoOutcome(destination, source, "taken", FileExistsError(
+                errno.EEXIST, "Original location is taken", source)))
+        else:
+            claimed.add(path_key(source))
+            moves.append((destination, source, size))
+    return moves, removals, conflicts
+
+
+def replay_record(op, source, destination, size, mtime_ns):
+    """Redo one journaled move; returns False if there was nothing to redo"""
+    if op != "move" or not _check_unchanged(source, size, mtime_ns):
+        return False
+    if os.path.lexists(destination):
+        raise FileExistsError(errno.EEXIST, "Destination is taken", destination)
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    shutil.move(source, destination)
+    return True
+
+
+class MovePlan:
+    """A sort worked out ahead of time, compact enough for 100,000s of files
+
+    Folder and category names are stored once, in tables; each move is its
+    file name plus table indexes, size and mtime in typed arrays. A move
+    never renames the file, only changes its folder.
+    """
+
+    # name -> array typecode of the per-move columns
+    columns = {"source_folders": "I", "destination_folders": "I",
+               "category_ids": "I", "sizes": "q", "mtimes": "q"}
+
+    def __init__(self):
+        self.folders = []
+        self.categories = []
+        self.names = []
+        # Files left where they are because their destination was taken
+        self.skipped = 0
+        for name, typecode in self.columns.items():
+            setattr(self, name, array.array(typecode))
+        self._folder_ids = {}
+        self._category_ids = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        """Yield (source, destination, size, mtime_ns) for every move"""
+        folders = self.folders
+        for name, source_folder, destination_folder, size, mtime_ns in zip(
+                self.names, self.source_folders, self.destination_folders, self.sizes, self.mtimes):
+            yield (os.path.join(folders[source_folder], name),
+                   os.path.join(folders[destination_folder], name), size, mtime_ns)
+
+    @staticmethod
+    def _intern(table, ids, value):
+        if (index := ids.get(value)) is None:
+            index = ids[value] = len(table)
+            table.append(value)
+        return index
+
+    def add(self, source, destination, category, size, mtime_ns):
+        source_folder, name = os.path.split(source)
+        self.names.append(name)
+        self.source_folders.append(self._intern(
+            self.folders, self._folder_ids, source_folder))
+        self.destination_folders.append(self._intern(
+            self.folders, self._folder_ids, os.path.dirname(destination)))
+        self.category_ids.append(self._intern(
+            self.categories, self._category_ids, category))
+        self.sizes.append(size)
+        self.mtimes.append(mtime_ns)
+
+    def totals(self):
+        """Return {category: (files, bytes)} for the planned moves"""
+        files = collections.Counter(self.category_ids)
+        sizes = collections.Counter()
+        for category_id, size in zip(self.category_ids, self.sizes):
+            sizes[category_id] += size
+        return {self.categories[category_id]: (count, sizes[category_id])
+                for category_id, count in files.items()}
+
+    def save(self, path):
+        data = {"version": 1, "folders": self.folders, "categories": self.categories,
+                "names": self.names, "skipped": self.skipped}
+        for name in self.columns:
+            column = getattr(self, name)
+            # Stored little-endian so a plan can move between machines
+            if sys.byteorder == "big":
+                column = array.array(column.typecode, column)
+                column.byteswap()
+            data[name] = base64.b64encode(column.tobytes()).decode("ascii")
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(data, file)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding="utf-8") as file:
+            data = json.load(file)
+        plan = cls()
+        plan.folders = data["folders"]
+        plan.categories = data["categories"]
+        plan.names = data["names"]
+        plan.skipped = data["skipped"]
+        for name, typecode in cls.columns.items():
+            column = array.array(typecode, base64.b64decode(data[name]))
+            if sys.byteorder == "big":
+                column.byteswap()
+            setattr(plan, name, column)
+        plan._folder_ids = {folder: index for index,
+                            folder in enumerate(plan.folders)}
+        plan._category_ids = {category: index for index,
+                              category in enumerate(plan.categories)}
+        return plan
+
+
+class ExtractorCore:
+    """Sorting, extraction and undo, without any GUI
+
+    Extractor adds the window on top; the command line uses it directly.
+    """
+
+    def __init__(self):
+        super().__init__()
+        # Define the criteria attribute
+        self.criteria = {}
+        self._criteria_matcher = None
+
+        # Initialize custom criteria
+        self.custom_criteria = {}  # Add this line
+        self.load_custom_criteria()
+
+        # Minimum fuzzy score a file needs to join an existing group
+        self.group_similarity_threshold = 0
+        # Files classified and moved per batch while sorting
+        self.sort_chunk_size = 1000
+        self.move_executor = MoveExecutor()
+        # Zips at least this big are extracted by several workers at once
+        self.split_archive_size = 256 * 1024 * 1024
+        # Depth, size and member limits for each archive, nested ones included
+        self.expansion_budget = ExpansionBudget()
+        self.archive_detector = ArchiveDetector()
+        # Reads .package indexes so they sort by content, not by name
+        self.package_classifier = PackageClassifier()
+        # Lets a repeat sort skip classifying files it has already seen
+        self.scan_index = ScanIndex()
+        # Every sort and extraction, kept on disk so it can be undone later
+        self.journal = UndoJournal()
+        # Set files already in their category folder aside instead of sorting
+        # them, into this folder beside the category folders
+        self.dedupe_on_sort = False
+        self.duplicates_folder = "Duplicates"
+        self.categories = {'Audio': {
+            'extensions': ['*.mp3', '*.wav', '*.ogg', '*.flac', '*.m4a', '*.aac', '*.wma'],
+            'pattern': 'audio*'
+        },
+            'Images': {
+            'extensions': ['*.jpg', '*.jpeg', '*.png', '*.bmp', '*.tiff', '*.gif', '*.webp', '*.ico'],
+            'pattern': 'image*'
+        },
+            'Documents': {
+            'extensions': ['*.pdf', '*.txt', '*.doc', '*.docx', '*.xls', '*.xlsx', '*.ppt', '*.pptx', '*.odt', '*.ods', '*.odp', '*.rtf', '*.csv'],
+            'pattern': 'doc*'
+        },
+            'Videos': {
+            'extensions': ['*.mp4', '*.avi', '*.mkv', '*.mov', '*.wmv', '*.flv', '*.m4v', '*.h264'],
+            'pattern': 'video*'
+        },
+            'Compressed': {
+            'extensions': ['*.zip', '*.rar', '*.7z', '*.tar', '*.gz', '*.bz2', '*.xz', '*.iso'],
+            'pattern': 'compressed*'
+        },
+            'Code': {
+            'extensions': ['*.py', '*.js', '*.html', '*.css', '*.php', '*.java', '*.cpp', '*.c', '*.cs', '*.sh', '*.bat', '*.swift', '*.go', '*.rb'],
+            'pattern': 'code*'
+        },
+            'Database': {
+            'extensions': ['*.db', '*.sql', '*.sqlite', '*.sqlite3', '*.mdb', '*.accdb'],
+            'pattern': 'database*'
+        },
+            'Fonts': {
+            'extensions': ['*.ttf', '*.otf', '*.woff', '*.woff2', '*.eot', '*.fon'],
+            'pattern': 'font*'
+        },
+            'Executable': {
+            'extensions': ['*.exe', '*.app', '*.bin', '*.msi', '*.dmg', '*.apk', '*.ipa'],
+            'pattern': 'executable*'
+        },
+            'Sims 4 Mods': {
+            'extensions': ['*.ts4script', '*.package', '*.trayitem', '*.blueprint', '*.room', '*.householdbinary', '*.bpi'],
+            'pattern': 'sims4mod*'
+        },
+            'Custom Content': {
+            'extensions': ['*.package'],
+            'pattern': 'cc_*'
+        },
+            'Script Mods': {
+            'extensions': ['*.ts4script'],
+            'pattern': 'scriptmod_*'
+        },
+            'Build Mode Objects': {
+            'extensions': ['*.package'],
+            'pattern': 'buildmode_*'
+        }
+        }
+
+    def plan_category_moves(self, source_folder, output_folder, only=None):
+        """Yield (source, destination) for every categorized file
+
+        only limits the plan to a set of paths inside source_folder. Files
+        whose name is already taken in their category folder are left alone.
+        """
+        fingerprint = criteria_fingerprint(
+            self.criteria, self.package_classifier.content, SCRIPT_CATEGORY)
+        folders = DirectoryCache()
+        entries = scan_folder(source_folder)
+        if only is not None:
+            entries = (entry for entry in entries if entry.path in only)
+        while chunk := list(itertools.islice(entries, self.sort_chunk_size)):
+            known = self.scan_index.lookup(chunk, fingerprint)
+            categories = self.categorize_files(
+                [entry.path for entry in chunk if entry.path not in known])
+            rows = []
+            for entry in chunk:
+                if entry.path in known:
+                    category = known[entry.path]
+                else:
+                    category = categories[entry.path]
+                    with contextlib.suppress(OSError):
+                        rows.append((entry.path, entry.size,
+                                     entry.mtime_ns, category))
+                if category:
+                    destination_folder = os.path.join(output_folder, category)
+                    folders.ensure(destination_folder)
+
+                    destination = os.path.join(destination_folder, entry.name)
+                    if not os.path.exists(destination):
+                        yield entry.path, destination
+            self.scan_index.update(rows, fingerprint)
+
+    def move_files(self, source_folder, output_folder):
+        return list(self.move_executor.run(
+            self.plan_category_moves(source_folder, output_folder)))
+
+    def add_criterion(self, name, extensions, pattern, description):
+        self.criteria[name] = {
+            "extensions": extensions,
+            "pattern": pattern,
+            "description": description}
+        self._criteria_matcher = None
+
+    def find_best_group(self, file_name, groups):
+        return groups.best(file_name, self.group_similarity_threshold)
+
+    def is_supported_file(self, file_path):
+        return self.archive_detector.detect([file_path])[file_path] is not None
+
+    def is_valid_directory(self, directory):
+        return os.path.isdir(directory)
+
+    def extract_archives(self, valid_files, destination, criteria=None, kinds=None, batch=None, progress=None):
+        """Extract archives in parallel, one per process
+
+        With criteria, members are routed straight into category folders.
+        kinds maps archives to the type ArchiveDetector found for them.
+        Produced files are journaled in batch, a new one if not given.
+        Returns (archive, files produced, bytes per second, error) per archive.
+        """
+        progress = progress or Progress()
+        batch = batch or self.journal.begin("extract")
+        progress.total_files = len(valid_files)
+        workers = os.cpu_count() or 1
+        kinds = kinds or self.archive_detector.detect(valid_files)
+        jobs = [(archive_path, job) for archive_path in valid_files
+                for job in self._extraction_jobs(archive_path, destination, criteria, workers, kinds[archive_path])]
+        # archive -> [files produced, bytes, seconds, error, jobs left]
+        totals = {archive_path: [0, 0, 0, None, 0]
+                  for archive_path in valid_files}
+        for archive_path, _ in jobs:
+            totals[archive_path][4] += 1
+
+        results = []
+        # Callers run this from GUI and watcher threads, and forking a
+        # threaded process can leave the child holding their locks
+        start_method = ("forkserver" if "forkserver" in multiprocessing.get_all_start_methods()
+                        else "spawn")
+        with concurrent.futures.ProcessPoolExecutor(
+                min(workers, len(jobs)),
+                mp_context=multiprocessing.get_context(start_method)) as pool:
+            futures = {pool.submit(*job): archive_path for archive_path, job in jobs}
+            for future in concurrent.futures.as_completed(futures):
+                if progress.cancelled.is_set():
+                    # Archives already extracting still finish and are recorded
+                    for pending in futures:
+                        pending.cancel()
+                if future.cancelled():
+                    continue
+                total = totals[futures[future]]
+                try:
+                    _, produced, size, seconds, error = future.result()
+                except Exception as e:
+                    total[3] = e
+                else:
+                    # Extracted files have no earlier location, so undo removes them
+                    for path in produced:
+                        with contextlib.suppress(OSError):
+                            stat = os.stat(path)
+                            batch.record("create", None, path,
+                                         stat.st_size, stat.st_mtime_ns)
+                    batch.sync()
+                    total[0] += len(produced)
+                    total[1] += size
+                    # Chunks of one archive run side by side
+                    total[2] = max(total[2], seconds)
+                    total[3] = total[3] or error
+
+                total[4] -= 1
+                if total[4] == 0:
+                    files, size, seconds, error, _ = total
+                    results.append((futures[future], files, 0 if error else size / max(seconds, 1e-6), error))
+                    progress.advance(1, size)
+        return results
+
+    def _extraction_jobs(self, archive_path, destination, criteria, workers, kind=None):
+        """Split a big zip into per-worker member chunks, else one job"""
+        single = [(extract_archive, archive_path,
+                   destination, criteria, self.expansion_budget, kind)]
+        if workers < 2 or kind != "zip":
+            return single
+        try:
+            if os.path.getsize(archive_path) < self.split_archive_size:
+                return single
+            with zipfile.ZipFile(archive_path) as archive:
+                matcher = CriteriaMatcher(criteria) if criteria else None
+                plan = list(plan_members(archive, destination, matcher))
+        except (OSError, zipfile.BadZipFile):
+            # Let the worker report the broken archive
+            return single
+        # Nested archives expand past their declared size, so they all go in
+        # one chunk of their own that gets the budget's slack
+        nested = [(member.filename, target) for member, target in plan
+                  if is_nested_archive(member.filename)]
+        chunks = split_members([(member, target) for member, target in plan
+                                if not is_nested_archive(member.filename)], workers)
+        if nested:
+            chunks.append(nested)
+        sizes = {member.filename: member.file_size for member, _ in plan}
+        budgets = self.expansion_budget.share(
+            [(sum(sizes[name] for name, _ in chunk), len(chunk)) for chunk in chunks],
+            len(chunks) - 1) if chunks else None
+        # Over budget as declared: one job fails the same way it would unsplit
+        if budgets is None:
+            return single
+        return [(extract_members, archive_path, destination, chunk, criteria, budget)
+                for chunk, budget in zip(chunks, budgets)]
+
+    def sort_extracted_files(self, source_folder, output_folder, progress=None, only=None, batch=None):
+        """Move extracted files into category folders; returns the failed moves"""
+        progress = progress or Progress()
+        batch = batch or self.journal.begin("sort")
+        if not os.path.exists(output_folder):
+            os.makedirs(output_folder)
+
+        failed = []
+        # Category folder -> {size: paths}, for dedupe_on_sort
+        contents = {}
+        hasher = FileHasher(self.scan_index)
+        folders = DirectoryCache()
+        plan = self.plan_category_moves(source_folder, output_folder, only)
+        while not progress.cancelled.is_set() and (chunk := list(itertools.islice(plan, self.sort_chunk_size))):
+            if self.dedupe_on_sort:
+                chunk = self._divert_duplicates(
+                    chunk, os.path.join(output_folder, self.duplicates_folder), contents, hasher, folders)
+            # Journal the chunk before any of it moves
+            moves = []
+            sizes = {}
+            for source, destination in chunk:
+                with contextlib.suppress(OSError):
+                    stat = os.stat(source)
+                    batch.record("move", source, destination,
+                                 stat.st_size, stat.st_mtime_ns)
+                    moves.append((source, destination))
+                    sizes[source] = stat.st_size
+            batch.sync()
+
+            for result in self.move_executor.run(moves, progress.cancelled):
+                if result.error:
+                    failed.append(result)
+                elif (folder := os.path.dirname(result.destination)) in contents:
+                    contents[folder].setdefault(
+                        sizes[result.source], []).append(result.destination)
+                progress.advance()
+        return failed
+
+    def _divert_duplicates(self, moves, duplicates_folder, contents, hasher, folders):
+        """Point the moves of files already sorted at duplicates_folder instead
+
+        A file counts as sorted when its contents match a file in its
+        category folder or one earlier in moves. Diverted files are still
+        moved, not deleted, so undo brings them back. Ones whose name is
+        taken there too stay where they are.
+        """
+        sizes = {}
+        for source, _ in moves:
+            with contextlib.suppress(OSError):
+                sizes[source] = os.path.getsize(source)
+        sorted_files = set()
+        for source, destination in moves:
+            folder = os.path.dirname(destination)
+            if folder not in contents:
+                contents[folder] = {}
+                for entry in scan_folder(folder):
+                    with contextlib.suppress(OSError):
+                        contents[folder].setdefault(
+                            entry.size, []).append(entry.path)
+            if source in sizes:
+                sorted_files.update(contents[folder].get(sizes[source], ()))
+
+        order = {source: index for index, (source, _) in enumerate(moves)}
+        duplicates = set()
+        for group in find_duplicates([*order, *sorted_files], hasher):
+            incoming = sorted((path for path in group if path in order), key=order.get)
+            # Keep the first copy unless one is already sorted
+            duplicates.update(
+                incoming if len(incoming) < len(group) else incoming[1:])
+
+        diverted = []
+        taken = set()
+        for source, destination in moves:
+            if source not in duplicates:
+                diverted.append((source, destination))
+                continue
+            target = os.path.join(duplicates_folder, os.path.basename(
+                os.path.dirname(destination)), os.path.basename(destination))
+            if path_key(target) not in taken and not os.path.exists(target):
+                taken.add(path_key(target))
+                folders.ensure(os.path.dirname(target))
+                diverted.append((source, target))
+        return diverted
+
+    def sort_new_files(self, paths, folder, progress=None):
+        """Extract the new archives among paths, then file them all by category
+
+        Returns (archive results, failed moves).
+        """
+        progress = progress or Progress()
+        # One undo step for the whole batch
+        batch = self.journal.begin("watch")
+        kinds = self.archive_detector.detect(paths)
+        # Content and name must both say archive
+        archives = [path for path in paths
+                    if kinds[path] and is_archive_name(path)]
+        results = self.extract_archives(
+            archives, folder, self.criteria, kinds, batch, progress) if archives else []
+        failed = self.sort_extracted_files(
+            folder, folder, progress, set(paths), batch)
+        return results, failed
+
+    def group_files(self, entries, selected_criteria, known=None):
+        """Assign a whole directory listing to groups in one pass
+
+        known maps paths to the group name the scan index remembers; those
+        files skip classification and join the first group of that name.
+        """
+        known = known or {}
+        # Define a priority list for sorting
+        priority_list = ["Mods", "Tray", "Archives"]
+
+        # Sort the priority list based on the selected criteria
+        priority_list = [
+            key for key in priority_list if key in selected_criteria]
+
+        # Bucket every file first so each bucket is scored in a single batch
+        buckets = {}
+        remembered = {}
+        for entry in entries:
+            if entry.path in known:
+                remembered.setdefault(known[entry.path], []).append(entry)
+                continue
+            # Sort by priority, based on the selected criteria
+            for key in priority_list:
+                if any(ext in entry.suffix for ext in selected_criteria[key]):
+                    group_name = key
+                    break
+            else:
+                group_name = os.path.splitext(entry.name)[0]
+            # Apply custom criteria
+            for custom_name, custom_criteria in self.custom_criteria.items():
+                extensions = custom_criteria["extensions"]
+                pattern = custom_criteria["pattern"]
+
+                if any(ext in entry.suffix for ext in extensions) or self.is_matching_pattern(entry.name, pattern):
+                    group_name = custom_name
+                    break
+            buckets.setdefault(group_name, []).append(entry)
+
+        # Sort files into subfolders based on names
+        grouped_files = {}
+        for group_name, bucket in buckets.items():
+            groups = grouped_files.setdefault(group_name, GroupIndex())
+            assigned = groups.assign([entry.name for entry in bucket],
+                                     group_name, self.group_similarity_threshold)
+            for entry, group in zip(bucket, assigned):
+                group["files"].append(entry)
+
+        # A group's folder is named after its bucket, so any group will do
+        for group_name, bucket in remembered.items():
+            groups = grouped_files.setdefault(group_name, GroupIndex())
+            if not len(groups):
+                groups.add({"name": group_name, "files": []})
+            next(iter(groups))["files"].extend(bucket)
+
+        return grouped_files
+
+    def plan_moves(self, grouped_files, folder):
+        """Yield (file, destination path) for every file that has to move"""
+        for groups in grouped_files.values():
+            for group in groups:
+                destination_folder = os.path.join(folder, group["name"])
+                for file in group["files"]:
+                    destination = os.path.join(destination_folder, file.name)
+                    if os.path.normcase(destination) != os.path.normcase(file.path):
+                        yield file, destination
+
+    def _plan_chunks(self, selected_criteria, folder, recursive, fingerprint, progress):
+        """Classify and plan a sort a chunk at a time, without moving anything
+
+        Yields (grouped_files, known, moves, skipped) for every chunk, where
+        moves are (file, destination) pairs and known is what the scan index
+        remembered. A whole tree is never held in memory, and as group
+        folders are named after their bucket, chunking doesn't change where
+        a file ends up.
+        """
+        # The total stays unknown rather than walk the tree twice
+        entries = scan_folder(folder)
+        if recursive:
+            # Group folders are always direct children of folder, so walking
+            # only the subfolders there at the start keeps out of new ones
+            with os.scandir(folder) as dir_entries:
+                subfolders = [dir_entry.path for dir_entry in dir_entries
+                              if dir_entry.is_dir(follow_symlinks=False)]
+            entries = itertools.chain(
+                entries, *(walk_folder(subfolder) for subfolder in subfolders))
+
+        while not progress.cancelled.is_set() and (chunk := list(itertools.islice(entries, self.sort_chunk_size))):
+            known = self.scan_index.lookup(chunk, fingerprint)
+            grouped_files = self.group_files(
+                chunk, selected_criteria, known)
+
+            moves = []
+            skipped = 0
+            for file, destination in self.plan_moves(grouped_files, folder):
+                # Files from different subfolders can still share a name;
+                # the move executor refuses whichever comes second
+                if os.path.exists(destination):
+                    skipped += 1
+                    continue
+                moves.append((file, destination))
+            yield grouped_files, known, moves, skipped
+
+    def sort_folder(self, selected_criteria, folder, recursive=False, progress=None):
+        """Sort folder without touching the GUI; returns (moved, skipped, failed)"""
+        progress = progress or Progress()
+        batch = self.journal.begin("sort")
+        moved_files = 0
+        skipped = 0
+        failed = 0
+        fingerprint = criteria_fingerprint(
+            selected_criteria, self.custom_criteria)
+        folders = DirectoryCache()
+
+        for grouped_files, known, moves, chunk_skipped in self._plan_chunks(
+                selected_criteria, folder, recursive, fingerprint, progress):
+            skipped += chunk_skipped
+
+            sizes = {}
+            journaled = []
+            for file, destination in moves:
+                # Gone since the scan
+                with contextlib.suppress(OSError):
+                    batch.record("move", file.path, destination,
+                                 file.size, file.mtime_ns)
+                    sizes[file.path] = file.size
+                    journaled.append((file.path, destination))
+            skipped += len(moves) - len(journaled)
+            # On disk before anything moves, so a crash can still be undone
+            batch.sync()
+
+            # Move files to subfolders based on their group
+            folders.ensure_all(os.path.dirname(destination)
+                               for _, destination in journaled)
+            moved = {}
+            for result in self.move_executor.run(journaled, progress.cancelled):
+                if isinstance(result.error, FileExistsError):
+                    # Taken by another file with the same name
+                    skipped += 1
+                elif result.error:
+                    failed += 1
+                else:
+                    moved_files += 1
+                    moved[result.source] = result.destination
+                progress.advance(1, sizes[result.source])
+
+            # Remember new files, and moved ones under their new path; a
+            # move keeps size and mtime, so the row stays valid there
+            rows = []
+            for groups in grouped_files.values():
+                for group in groups:
+                    for file in group["files"]:
+                        if file.path in known and file.path not in moved:
+                            continue
+                        with contextlib.suppress(OSError):
+                            rows.append((moved.get(file.path, file.path), file.size,
+                                         file.mtime_ns, group["name"]))
+            self.scan_index.update(rows, fingerprint, moved)
+
+        return moved_files, skipped, failed
+
+    def plan_sort(self, selected_criteria, folder, recursive=False, progress=None):
+        """Work out a whole sort as a MovePlan, changing nothing on disk"""
+        progress = progress or Progress()
+        plan = MovePlan()
+        fingerprint = criteria_fingerprint(
+            selected_criteria, self.custom_criteria)
+        for _, _, moves, skipped in self._plan_chunks(selected_criteria, folder, recursive, fingerprint, progress):
+            plan.skipped += skipped
+            for file, destination in moves:
+                with contextlib.suppress(OSError):
+                    # The group folder is named after the category
+                    plan.add(file.path, destination, os.path.basename(os.path.dirname(destination)),
+                             file.size, file.mtime_ns)
+                    progress.advance(1, file.size)
+        return plan
+
+    def execute_plan(self, plan, progress=None):
+        """Carry out a MovePlan; returns (moved, skipped, failed)
+
+        Files that changed or vanished since the plan was made, or whose
+        destination has been taken since, are skipped.
+        """
+        progress = progress or Progress()
+        progress.total_files = len(plan)
+        batch = self.journal.begin("sort")
+        moved_files = 0
+        skipped = 0
+        failed = 0
+        # Every folder the plan moves into, made before the first move
+        DirectoryCache().ensure_all(
+            plan.folders[index] for index in set(plan.destination_folders))
+        planned = iter(plan)
+        while not progress.cancelled.is_set() and (chunk := list(itertools.islice(planned, self.sort_chunk_size))):
+            moves = []
+            sizes = {}
+            for source, destination, size, mtime_ns in chunk:
+                try:
+                    ready = _check_unchanged(
+                        source, size, mtime_ns) and not os.path.lexists(destination)
+                except OSError:
+                    ready = False
+                if not ready:
+                    skipped += 1
+                    progress.advance()
+                    continue
+                sizes[source] = size
+                batch.record("move", source, destination, size, mtime_ns)
+                moves.append((source, destination))
+            batch.sync()
+
+            for result in self.move_executor.run(moves, progress.cancelled):
+                if isinstance(result.error, FileExistsError):
+                    skipped += 1
+                elif result.error:
+                    failed += 1
+                else:
+                    moved_files += 1
+                progress.advance(1, sizes[result.source])
+        return moved_files, skipped, failed
+
+    def get_criteria_matcher(self):
+        # Rebuild only when the criteria dict was replaced or edited
+        if self._criteria_matcher is None or self._criteria_matcher.criteria is not self.criteria:
+            self._criteria_matcher = CriteriaMatcher(self.criteria)
+        return self._criteria_matcher
+
+    def categorize_mods(self, file_path):
+        return self.get_criteria_matcher().match(os.path.basename(file_path))
+
+    def categorize_files(self, paths):
+        """Return {path: category or None}
+
+        A .package goes to the category its resources point to, and a
+        .ts4script with Python modules inside to SCRIPT_CATEGORY, when that
+        is one of the criteria; everything else is matched by name.
+        """
+        by_content = self.package_classifier.classify(paths)
+        scripts = [path for path in paths
+                   if path.lower().endswith(".ts4script")]
+        if scripts:
+            by_content.update((mod.path, SCRIPT_CATEGORY)
+                              for mod in inspect_scripts(scripts) if mod.modules)
+        return {path: by_content[path] if by_content.get(path) in self.criteria else self.categorize_mods(path)
+                for path in paths}
+
+    def load_custom_criteria(self):
+        with contextlib.suppress(FileNotFoundError):
+            with open("custom_criteria.json", "r") as file:
+                self.custom_criteria = json.load(file)
+        compile_pattern.cache_clear()
+
+    def save_custom_criteria(self):
+        with open("custom_criteria.json", "w") as file:
+            json.dump(self.custom_criteria, file)
+        compile_pattern.cache_clear()
+
+    def is_matching_pattern(self, file_name, pattern):
+        is_glob, regex = compile_pattern(pattern)
+        if is_glob:
+            file_name = os.path.normcase(file_name)
+        return bool(regex.match(file_name))
+
+    def undo_last_batch(self, progress=None):
+        """Revert the newest batch that still has files to put back"""
+        for batch_id in reversed(self.journal.batches()):
+            if outcomes := self.undo_batch(batch_id, progress=progress):
+                return outcomes
+        return []
+
+    def undo_folder(self, folder, progress=None):
+        """Put back the journaled files now in folder; returns their UndoOutcomes"""
+        progress = progress or Progress()
+        outcomes = []
+        for batch_id in reversed(self.journal.batches()):
+            outcomes += self.undo_batch(batch_id, folder, progress)
+        return outcomes
+
+    def undo_batch(self, batch_id, folder=None, progress=None):
+        """Revert one batch, or only its files directly inside folder
+
+        Each chunk of records is checked against the disk first; conflicts
+        are left alone and reported, and the rest move back in parallel.
+        Returns an UndoOutcome for every file that had something to undo.
+        """
+        progress = progress or Progress()
+        outcomes = []
+        folders = DirectoryCache()
+        records = self.journal.records(batch_id) if folder is None else self.journal.folder_records(
+            batch_id, folder)
+        while not progress.cancelled.is_set() and (chunk := list(itertools.islice(records, self.sort_chunk_size))):
+            moves, removals, conflicts = plan_revert(chunk)
+            outcomes += conflicts
+
+            for path in removals:
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    outcomes.append(UndoOutcome(path, None, "failed", e))
+                else:
+                    outcomes.append(UndoOutcome(path, None, "removed", None))
+                progress.advance()
+
+            sizes = {current: size for current, _, size in moves}
+            for original_folder in {os.path.dirname(original) for _, original, _ in moves}:
+                # A failure here surfaces as those files' moves failing
+                with contextlib.suppress(OSError):
+                    folders.ensure(original_folder)
+            for result in self.move_executor.run([move[:2] for move in moves], progress.cancelled):
+                outcomes.append(UndoOutcome(result.source, result.destination,
+                                            "failed" if result.error else "restored", result.error))
+                progress.advance(1, sizes[result.source])
+
+        if folder is None and not progress.cancelled.is_set() and all(outcome.error is None for outcome in outcomes):
+            self.journal.retire(batch_id)
+        return outcomes
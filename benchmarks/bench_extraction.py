@@ -0,0 +1,71 @@
+"""Compare single-process and member-parallel extraction of one big zip
+
+Usage: python benchmarks/bench_extraction.py [archive size in MB] [workers]
+Builds a synthetic archive (2 GB by default) in a temporary folder.
+"""
+import concurrent.futures
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from archistack_core import extract_archive, extract_members, plan_members, split_members  # noqa: E402
+
+
+def make_archive(path, total_size):
+    rng = random.Random(0)
+    # Half random, half repeated, so deflate has real work to do
+    block = rng.randbytes(512 * 1024) + bytes(512 * 1024)
+    written = index = 0
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as archive:
+        while written < total_size:
+            size = min(rng.randint(1, 64) * 1024 * 1024, total_size - written)
+            with archive.open(f"creator{index % 50}/cc_item_{index}.package", "w") as member:
+                for _ in range(size // len(block)):
+                    member.write(block)
+                member.write(block[:size % len(block)])
+            written += size
+            index += 1
+    return index
+
+
+def extract_parallel(archive_path, destination, workers):
+    with zipfile.ZipFile(archive_path) as archive:
+        chunks = split_members(
+            list(plan_members(archive, destination, None)), workers)
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(extract_members, archive_path, destination, chunk)
+                   for chunk in chunks]
+        return sum(future.result()[2] for future in futures)
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 2048
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count() or 1
+
+    folder = tempfile.mkdtemp()
+    try:
+        archive_path = os.path.join(folder, "collection.zip")
+        members = make_archive(archive_path, size_mb * 1024 * 1024)
+        print(f"{size_mb} MB archive, {members} members, {workers} workers")
+
+        for label, extract in (("single", lambda destination: extract_archive(archive_path, destination)[2]),
+                               (f"{workers} workers", lambda destination: extract_parallel(archive_path, destination, workers))):
+            destination = os.path.join(folder, label.replace(" ", "_"))
+            os.makedirs(destination)
+            start = time.perf_counter()
+            size = extract(destination)
+            elapsed = time.perf_counter() - start
+            print(f"{label:>12}: {elapsed:6.2f} s  {size / elapsed / 1024 / 1024:8.1f} MB/s")
+            shutil.rmtree(destination)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""Compare ways of scoring file names against many existing groups
+
+The linear scan is the original find_best_group loop, calling
+fuzz.token_set_ratio for every group in turn. GroupIndex.best is the
+indexed per-file lookup and GroupIndex.assign the batched one. The linear
+scan takes minutes past --linear-max files, so it is left out there.
+
+Usage: python benchmarks/bench_grouping.py [--groups N] [--linear-max N] [sizes...]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rapidfuzz import fuzz  # noqa: E402
+from rapidfuzz.utils import default_process  # noqa: E402
+
+from archistack_core import GroupIndex  # noqa: E402
+
+CREATORS = [f"creator{i}" for i in range(200)]
+ITEMS = ["hair", "top", "bottom", "shoes", "skin", "eyes",
+         "tattoo", "sofa", "lamp", "rug", "tuning", "override"]
+
+
+def make_group_names(count, seed=1):
+    """count distinct group names from the same words the files use"""
+    rng = random.Random(seed)
+    names = set()
+    while len(names) < count:
+        names.add(f"{rng.choice(CREATORS)} {rng.choice(ITEMS)} {rng.choice(ITEMS)}")
+    return sorted(names)
+
+
+def make_names(count, seed=0):
+    rng = random.Random(seed)
+    return [f"{rng.choice(CREATORS)}_{rng.choice(ITEMS)}_{rng.choice(ITEMS)}_v{rng.randint(1, 9)}_{index}.package"
+            for index in range(count)]
+
+
+def linear(names, group_names, group_name, threshold):
+    # Names are normalized once up front, as GroupIndex does
+    groups = [default_process(name) for name in group_names]
+    for name in names:
+        name = default_process(name)
+        best_group = None
+        best_score = threshold
+        for group in groups:
+            score = fuzz.token_set_ratio(name, group)
+            if score > best_score:
+                best_group = group
+                best_score = score
+        if best_group is None:
+            groups.append(default_process(group_name))
+    return len(groups)
+
+
+def indexed(names, group_names, group_name, threshold):
+    groups = GroupIndex()
+    for name in group_names:
+        groups.add({"name": name, "files": []})
+    for name in names:
+        if groups.best(name, threshold) is None:
+            groups.add({"name": group_name, "files": []})
+    return len(groups)
+
+
+def batched(names, group_names, group_name, threshold):
+    groups = GroupIndex()
+    for name in group_names:
+        groups.add({"name": name, "files": []})
+    groups.assign(names, group_name, threshold)
+    return len(groups)
+
+
+def main():
+    args = sys.argv[1:]
+    options = {"--groups": 2000, "--linear-max": 10_000}
+    while args[:1] and args[0] in options:
+        options[args[0]] = int(args[1])
+        args = args[2:]
+    group_count = options["--groups"]
+    sizes = [int(size) for size in args] or [10_000, 100_000, 500_000]
+    # Files scored against many distinct groups, with some misses
+    group_names = make_group_names(group_count)
+    group_name, threshold = "unsorted", 80
+
+    print(f"{group_count} groups")
+    print(f"{'files':>8} {'linear s':>9} {'indexed s':>10} {'batched s':>10} {'vs linear':>10} {'vs indexed':>11}")
+    for size in sizes:
+        names = make_names(size)
+        scorers = [indexed, batched]
+        if size <= options["--linear-max"]:
+            scorers.insert(0, linear)
+        timings = []
+        counts = []
+        for scorer in scorers:
+            start = time.perf_counter()
+            counts.append(scorer(names, group_names, group_name, threshold))
+            timings.append(time.perf_counter() - start)
+
+        assert len(set(counts)) == 1, counts
+        *slow, middle, fast = timings
+        if slow:
+            linear_columns = f"{slow[0]:>9.2f}"
+            speedup = f"{slow[0] / fast:>9.1f}x"
+        else:
+            linear_columns = f"{'-':>9}"
+            speedup = f"{'-':>10}"
+        print(f"{size:>8} {linear_columns} {middle:>10.2f} {fast:>10.2f} {speedup} {middle / fast:>10.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Archives stop extracting once they would expand past their budget"""
+import gzip
+import io
+import os
+import tarfile
+import zipfile
+
+from archistack_core import ArchiveBudgetError, ExpansionBudget, extract_archive
+
+
+def make_zip(path, members):
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, data in members.items():
+            archive.writestr(name, data)
+
+
+def test_zip_within_budget(tmp_path):
+    make_zip(tmp_path / "a.zip", {"one.txt": b"1", "dir/two.txt": b"22"})
+    _, produced, size, _, error = extract_archive(
+        str(tmp_path / "a.zip"), str(tmp_path / "out"), budget=ExpansionBudget(max_members=2, max_bytes=3))
+    assert error is None
+    assert size == 3
+    assert sorted(os.path.relpath(path, tmp_path / "out") for path in produced) == [
+        os.path.join("dir", "two.txt"), "one.txt"]
+
+
+def test_zip_over_member_budget(tmp_path):
+    make_zip(tmp_path / "a.zip", {f"{index}.txt": b"x" for index in range(10)})
+    _, produced, _, _, error = extract_archive(
+        str(tmp_path / "a.zip"), str(tmp_path / "out"), budget=ExpansionBudget(max_members=4))
+    assert isinstance(error, ArchiveBudgetError)
+    assert len(produced) == 4
+
+
+def test_zip_over_byte_budget(tmp_path):
+    # Compresses to almost nothing, as a zip bomb would
+    make_zip(tmp_path / "a.zip", {"big.bin": b"\0" * 100_000})
+    _, produced, _, _, error = extract_archive(
+        str(tmp_path / "a.zip"), str(tmp_path / "out"), budget=ExpansionBudget(max_bytes=10_000))
+    assert isinstance(error, ArchiveBudgetError)
+    assert produced == []
+    assert not [name for _, _, names in os.walk(tmp_path / "out") for name in names]
+
+
+def test_nested_zip_counts_against_outer_budget(tmp_path):
+    inner = io.BytesIO()
+    make_zip(inner, {"inner.txt": b"i" * 5000})
+    make_zip(tmp_path / "a.zip", {"nested.zip": inner.getvalue(), "outer.txt": b"o" * 5000})
+    _, _, _, _, error = extract_archive(
+        str(tmp_path / "a.zip"), str(tmp_path / "out"), budget=ExpansionBudget(max_bytes=8000))
+    assert isinstance(error, ArchiveBudgetError)
+
+
+def test_nested_zip_past_max_depth_is_kept_whole(tmp_path):
+    inner = io.BytesIO()
+    make_zip(inner, {"inner.txt": b"i"})
+    make_zip(tmp_path / "a.zip", {"nested.zip": inner.getvalue()})
+    _, produced, _, _, error = extract_archive(
+        str(tmp_path / "a.zip"), str(tmp_path / "out"), budget=ExpansionBudget(max_depth=0))
+    assert error is None
+    assert [os.path.basename(path) for path in produced] == ["nested.zip"]
+
+
+def test_tar_over_byte_budget(tmp_path):
+    with tarfile.open(tmp_path / "a.tar.gz", "w:gz") as archive:
+        for index in range(3):
+            info = tarfile.TarInfo(f"{index}.bin")
+            info.size = 4000
+            archive.addfile(info, io.BytesIO(b"\0" * info.size))
+    _, produced, _, _, error = extract_archive(
+        str(tmp_path / "a.tar.gz"), str(tmp_path / "out"), budget=ExpansionBudget(max_bytes=10_000))
+    assert isinstance(error, ArchiveBudgetError)
+    assert len(produced) == 2
+
+
+def test_gzip_over_byte_budget(tmp_path):
+    with gzip.open(tmp_path / "big.bin.gz", "wb") as file:
+        file.write(b"\0" * 1_000_000)
+    _, produced, _, _, error = extract_archive(
+        str(tmp_path / "big.bin.gz"), str(tmp_path / "out"), budget=ExpansionBudget(max_bytes=64 * 1024))
+    assert isinstance(error, ArchiveBudgetError)
+    # The partly written file is removed
+    assert produced == []
+    assert not os.path.exists(tmp_path / "out" / "big.bin")
+
+
+def test_share_gives_the_slack_to_the_nested_chunk():
+    budget = ExpansionBudget(max_bytes=1000, max_members=10)
+    first, nested = budget.share([(100, 2), (300, 1)], nested_chunk=1)
+    assert (first.max_bytes, first.max_members) == (100, 2)
+    assert (nested.max_bytes, nested.max_members) == (900, 8)
+    assert budget.share([(600, 1), (600, 1)]) is None
@@ -0,0 +1,38 @@
+"""CriteriaMatcher picks the same category as the first-match scan it replaced"""
+import fnmatch
+import itertools
+
+from archistack_core import CriteriaMatcher, ExtractorCore
+
+
+def first_match(criteria, file_name):
+    # The original loop: the first criterion whose pattern and one of whose
+    # extensions match the name wins
+    for category, criterion in criteria.items():
+        extensions = [ext if any(char in ext for char in "*?[") else f"*{ext}"
+                      for ext in criterion["extensions"] if ext]
+        if fnmatch.fnmatch(file_name, criterion["pattern"]) and any(
+                fnmatch.fnmatch(file_name, ext) for ext in extensions):
+            return category
+    return None
+
+
+def test_same_category_as_first_match(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    criteria = dict(ExtractorCore().categories)
+    # Overlapping criteria, plain extensions and wildcards inside them
+    criteria["Notes"] = {"extensions": [".txt", ".md"], "pattern": "*"}
+    criteria["Backups"] = {"extensions": ["*.tar.*", "*.bak"], "pattern": "*"}
+    criteria["Empty"] = {"extensions": [""], "pattern": "*"}
+    matcher = CriteriaMatcher(criteria)
+
+    stems = ["audio_mix", "image01", "doc", "notes", "sims4mod_hair", "backup", "font", "x", ""]
+    suffixes = [".mp3", ".txt", ".md", ".tar.gz", ".bak", ".package", ".py",
+                ".PNG", ".unknown", "", ".", ".tar"]
+    for stem, suffix in itertools.product(stems, suffixes):
+        file_name = stem + suffix
+        assert matcher.match(file_name) == first_match(criteria, file_name), file_name
+
+
+def test_no_criteria_matches_nothing():
+    assert CriteriaMatcher({}).match("audio.mp3") is None
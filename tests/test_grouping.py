@@ -0,0 +1,76 @@
+"""GroupIndex lands every file in the same group as scoring every group in turn"""
+import random
+
+import pytest
+from rapidfuzz import fuzz
+from rapidfuzz.utils import default_process
+
+from archistack_core import GroupIndex
+
+WORDS = ["creator", "hair", "top", "Hair_Top", "sofa", "lamp lamp", "v2", "a", "bb", ""]
+
+
+def random_name(rng):
+    return "_".join(rng.choice(WORDS) for _ in range(rng.randint(0, 4)))
+
+
+def linear_groups(group_names, file_names, group_name, threshold):
+    # find_best_group as it was: every group scored, the first best kept
+    groups = list(group_names)
+    assigned = []
+    for file_name in file_names:
+        best_position = None
+        best_score = threshold
+        for position, name in enumerate(groups):
+            score = fuzz.token_set_ratio(default_process(file_name), default_process(name))
+            if score > best_score:
+                best_position = position
+                best_score = score
+        if best_position is None:
+            best_position = len(groups)
+            groups.append(group_name)
+        assigned.append(best_position)
+    return assigned, len(groups)
+
+
+def positions(index, groups):
+    return [next(position for position, group in enumerate(index.groups) if group is found)
+            for found in groups]
+
+
+def prefilled(group_names):
+    index = GroupIndex()
+    for name in group_names:
+        index.add({"name": name, "files": []})
+    return index
+
+
+@pytest.mark.parametrize("seed", range(150))
+def test_best_and_assign_match_linear_scan(seed):
+    rng = random.Random(seed)
+    group_names = [random_name(rng) for _ in range(rng.randint(0, 10))]
+    file_names = [random_name(rng) for _ in range(rng.randint(1, 30))]
+    group_name = rng.choice(group_names + ["unsorted"])
+    threshold = rng.choice([0, 50, 80])
+    expected, group_count = linear_groups(group_names, file_names, group_name, threshold)
+
+    index = prefilled(group_names)
+    found = []
+    for file_name in file_names:
+        group = index.best(file_name, threshold)
+        if group is None:
+            group = {"name": group_name, "files": []}
+            index.add(group)
+        found.append(group)
+    assert positions(index, found) == expected
+    assert len(index) == group_count
+
+    index = prefilled(group_names)
+    # Tiny blocks so a file's first miss can fall in any block
+    index.assign_block_cells = rng.choice([1, 5, 1 << 22])
+    assert positions(index, index.assign(file_names, group_name, threshold)) == expected
+    assert len(index) == group_count
+
+
+def test_assign_nothing():
+    assert GroupIndex().assign([], "unsorted") == []
@@ -0,0 +1,78 @@
+"""A sort is journaled so it can be undone, and undo never overwrites anything"""
+import os
+
+import pytest
+
+from archistack_core import ExtractorCore, ScanIndex, UndoJournal
+
+FILES = ["audio_mix.mp3", "image_one.png", "notes.txt", "sims4mod_hair.package"]
+
+
+@pytest.fixture
+def core(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    core = ExtractorCore()
+    core.criteria = dict(core.categories)
+    core.scan_index = ScanIndex(str(tmp_path / "index.sqlite"))
+    core.journal = UndoJournal(str(tmp_path / "journal"))
+    return core
+
+
+@pytest.fixture
+def folder(tmp_path):
+    folder = tmp_path / "mods"
+    folder.mkdir()
+    for name in FILES:
+        (folder / name).write_text(name)
+    return folder
+
+
+def listing(folder):
+    return sorted(os.path.relpath(os.path.join(root, name), folder)
+                  for root, _, names in os.walk(folder) for name in names)
+
+
+def test_sort_then_undo_round_trip(core, folder):
+    moved, skipped, failed = core.sort_folder(core.criteria, str(folder))
+    assert (moved, skipped, failed) == (len(FILES), 0, 0)
+    assert listing(folder) != sorted(FILES)
+
+    (batch_id,) = core.journal.batches()
+    records = list(core.journal.records(batch_id))
+    assert sorted(os.path.basename(source) for _, source, _, _, _ in records) == sorted(FILES)
+    assert all(os.path.isabs(source) and os.path.isabs(destination)
+               for _, source, destination, _, _ in records)
+
+    outcomes = core.undo_last_batch()
+    assert sorted(outcome.status for outcome in outcomes) == ["restored"] * len(FILES)
+    assert listing(folder) == sorted(FILES)
+    # A fully undone batch is retired and can be redone
+    assert core.journal.batches() == []
+    assert core.journal.replay(batch_id) == (len(FILES), [])
+    assert listing(folder) != sorted(FILES)
+
+
+def test_undo_leaves_conflicts_alone(core, folder):
+    core.sort_folder(core.criteria, str(folder))
+    (batch_id,) = core.journal.batches()
+    moves = {os.path.basename(source): destination
+             for _, source, destination, _, _ in core.journal.records(batch_id)}
+
+    # Something new took one file's old place, and another file was edited
+    (folder / "notes.txt").write_text("new notes")
+    with open(moves["image_one.png"], "a") as file:
+        file.write("edited")
+
+    outcomes = {os.path.basename(outcome.path): outcome for outcome in core.undo_last_batch()}
+    assert outcomes["notes.txt"].status == "taken"
+    assert outcomes["image_one.png"].status == "modified"
+    assert outcomes["audio_mix.mp3"].status == "restored"
+    assert (folder / "notes.txt").read_text() == "new notes"
+    assert os.path.exists(moves["notes.txt"])
+    assert os.path.exists(moves["image_one.png"])
+    # Conflicts keep the batch around for a later undo
+    assert core.journal.batches() == [batch_id]
+
+
+def test_undo_with_nothing_to_undo(core):
+    assert core.undo_last_batch() == []